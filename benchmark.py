@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import pandas as pd
+from datetime import timedelta
+
+# Scaling benchmark for the billing report over synthetic line items (functions.synthetic).
+# Each scale runs in its own process so peak memory is measured per scale. Times loading the sample
+# (columnar copy, full and ranged loads), filter_data, each report section and the other engines, and a
+# warehouse result transferred as dict rows against Arrow record batches (through a stand-in client).
+#
+#   python benchmark.py --rows 100000 1000000 10000000 --output bench.jsonl
+#
+# Generated CSVs are kept in bench_dir and reused by later runs with the same rows and seed.
+# Linux only. Each step records how much it grew the resident set (rss_mib, what it still holds
+# afterwards) and its peak above where it started (peak_mib); the peak is reset before every step
+# through /proc/self/clear_refs. Per scale, imports_mib is the resident set before the first step.
+
+bench_dir = os.path.join('data', '.cache', 'bench')
+# The dict row transfer holds one Python object per value; above this many rows it runs out of memory.
+dict_rows_limit = 1_000_000
+
+def rss_mib():
+    # Current and peak resident set size since the last reset_peak_rss (VmRSS and VmHWM are in KiB).
+    sizes = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                sizes[line[:5]] = int(line.split()[1]) / 1024
+    return sizes['VmRSS'], sizes['VmHWM']
+
+def reset_peak_rss():
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+def timed(results, name, step):
+    before, _ = rss_mib()
+    reset_peak_rss()
+    started = time.perf_counter()
+    value = step()
+    seconds = time.perf_counter() - started
+    after, peak = rss_mib()
+    results[name] = {'seconds': round(seconds, 4), 'rss_mib': round(after - before, 1), 'peak_mib': round(peak - before, 1)}
+    return value
+
+class StandInJob:
+    # A finished BigQuery query job: rows one dict at a time, or Arrow record batches.
+    def __init__(self, table):
+        self.table = table
+
+    def result(self):
+        return self
+
+    def __iter__(self):
+        for batch in self.table.to_batches(max_chunksize=5000):
+            yield from batch.to_pylist()
+
+    def to_arrow_iterable(self):
+        return iter(self.table.to_batches(max_chunksize=5000))
+
+class StandInClient:
+    # Serves the generated line items for any query in place of bigquery.Client, so only the transfer is timed.
+    def __init__(self, table):
+        self.table = table
+
+    def query(self, sql, job_config=None):
+        return StandInJob(self.table)
+
+def run_scale(rows, seed):
+    # Streamlit caches are bypassed: every step calls the uncached builder behind it.
+    from functions import query, duckdb_engine, polars_engine
+    from functions.synthetic import write_line_items_csv
+    from functions.cache import columnar_cache_file, partitioned_dataset_file, read_csv_table, ipc_to_table
+    from functions.filters import filter_data
+    from functions.aggregates import daily_aggregates, prefix_sums, range_totals, range_months
+    from functions.cube import build_revenue_cube, cube_range
+    from functions.report import revenue_metrics, subscription_metrics, product_metrics, customer_metrics
+
+    results = {}
+    imports_mib, _ = rss_mib()
+    os.makedirs(bench_dir, exist_ok=True)
+    path = os.path.join(bench_dir, f"line_item_enhanced-{rows}-{seed}.csv")
+    if not os.path.exists(path):
+        timed(results, 'generate', lambda: write_line_items_csv(path, rows, query.data_dtypes, seed))
+    query.data_path = path
+
+    timed(results, 'columnar_copy', lambda: columnar_cache_file(path, query.data_dtypes))
+    timed(results, 'partitioned_copy', lambda: partitioned_dataset_file(path, query.data_dtypes))
+    data = timed(results, 'load', lambda: query.load_line_items('BigQuery', columns=query.report_columns))
+
+    # A warehouse result turned into a frame: one dict per row (the earlier fetch) against fetch_arrow.
+    client = StandInClient(read_csv_table(path, query.data_dtypes, query.report_columns))
+    sql, params = query.line_item_query(query.report_columns)
+    if rows <= dict_rows_limit:
+        timed(results, 'warehouse_dict_rows', lambda: pd.DataFrame([dict(row) for row in client.query(sql).result()], columns=query.report_columns))
+    timed(results, 'warehouse_arrow', lambda: query.line_items_frame(ipc_to_table(query.fetch_arrow(client, sql, params)), query.report_columns))
+    del client
+
+    # The report's default range: the year up to the last created_at.
+    end_date = data['created_at'].max().date()
+    start_date = end_date - timedelta(days=365)
+    # A ranged read of the month partitions, which the page does with partition_local_data.
+    query.partition_local_data = True
+    timed(results, 'load_range', lambda: query.load_line_items('BigQuery', start_date, end_date, query.report_columns))
+    query.partition_local_data = False
+    filtered = timed(results, 'filter', lambda: filter_data(start_date, end_date, data))
+
+    # The daily index and revenue cube are built once per dataset; each range then only slices them.
+    daily = timed(results, 'daily_index', lambda: daily_aggregates(data))
+    prefix = prefix_sums(daily)
+    cube = timed(results, 'revenue_cube', lambda: build_revenue_cube(data))
+    range_total = range_totals(daily, prefix, start_date, end_date)
+    monthly = timed(results, 'range_months', lambda: range_months(daily, start_date, end_date))
+    cells = timed(results, 'cube_range', lambda: cube_range(cube, start_date, end_date))
+
+    timed(results, 'revenue', lambda: revenue_metrics(filtered, start_date, end_date, range_total, monthly))
+    timed(results, 'subscriptions', lambda: subscription_metrics(filtered))
+    timed(results, 'products', lambda: product_metrics(cells))
+    timed(results, 'customers', lambda: customer_metrics(filtered, monthly))
+    timed(results, 'duckdb_report', lambda: duckdb_engine.report_metrics(data, start_date, end_date))
+    timed(results, 'polars_report', lambda: polars_engine.report_metrics(polars_engine.scan_line_items(partitioned_dataset_file(path, query.data_dtypes), start_date, end_date), start_date, end_date))
+
+    return {'rows': rows, 'seed': seed, 'loaded_mib': round(query.frame_nbytes(data) / 2**20, 1),
+            'imports_mib': round(imports_mib, 1), 'steps': results}
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the billing report over synthetic line items at several scales.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='append one JSON line per scale to this file')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_scale(args.rows[0], args.seed)))
+        return
+
+    for rows in args.rows:
+        completed = subprocess.run([sys.executable, __file__, '--single', '--rows', str(rows), '--seed', str(args.seed)],
+                                   capture_output=True, text=True, check=True)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+        steps = pd.DataFrame(result['steps']).T
+        print(f"{rows:,} rows · loaded {result['loaded_mib']:,.1f} MiB · {result['imports_mib']:,.1f} MiB resident before the first step")
+        print(steps.to_string(), end='\n\n')
+
+if __name__ == '__main__':
+    main()
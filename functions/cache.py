@@ -0,0 +1,187 @@
+import hashlib
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pandas as pd
+from functions.manifest import build_manifest, write_manifest, read_manifest
+
+# Columnar copies of the source exports live next to the data, one file per source version.
+cache_dir = os.path.join('data', '.cache')
+
+# Month partitions of the Parquet copy (year=YYYY/month=M, from created_at) and rows per row group.
+# Each row group records min/max statistics, so a narrow range also skips row groups within a month.
+partitioning = ds.partitioning(pa.schema([('year', pa.int32()), ('month', pa.int32())]), flavor='hive')
+row_group_rows = 64 * 1024
+
+# Arrow types for the pandas dtypes used in functions.query.data_dtypes.
+arrow_types = {
+    'string': pa.string(),
+    'Int64': pa.int64(),
+    'float64': pa.float64(),
+    'datetime64[ns]': pa.timestamp('ns'),
+}
+
+def source_fingerprint(path):
+    # Size + mtime is cheap enough to check on every rerun; the content hash is recorded when the cache is built.
+    stat = os.stat(path)
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+def content_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def arrow_schema(dtypes):
+    return pa.schema([(col, arrow_types[dtype]) for col, dtype in dtypes.items()])
+
+def columnar_cache_path(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{name}-{source_fingerprint(path)}.arrow")
+
+def manifest_path(cache_path):
+    # The manifest describing a columnar copy sits next to it.
+    return cache_path[:-len('.arrow')] + '.manifest.json'
+
+def build_columnar_cache(path, dtypes):
+    # Parse the CSV once with explicit types so no column is left to inference.
+    timestamp_columns = [col for col, dtype in dtypes.items() if dtype.startswith('datetime64')]
+    csv_dtypes = {col: dtype for col, dtype in dtypes.items() if col not in timestamp_columns}
+    data = pd.read_csv(path, dtype=csv_dtypes, parse_dates=timestamp_columns)
+
+    source_sha256 = content_hash(path)
+    schema = arrow_schema(dtypes).with_metadata({'source_sha256': source_sha256})
+    table = pa.Table.from_pandas(data[list(dtypes)], schema=schema, preserve_index=False)
+
+    # Write uncompressed Arrow IPC so reads can memory-map the buffers directly.
+    # The temp file + rename keeps concurrent readers from seeing a partial file.
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = columnar_cache_path(path)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, cache_path)
+    write_manifest(manifest_path(cache_path), build_manifest(table, source_sha256))
+
+    # Drop copies (and their manifests) built from older versions of the same source.
+    prefix = os.path.basename(cache_path).rsplit('-', 2)[0] + '-'
+    for name in os.listdir(cache_dir):
+        stale = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and name.endswith(('.arrow', '.manifest.json')) and stale not in (cache_path, manifest_path(cache_path)):
+            os.remove(stale)
+
+    return cache_path
+
+def read_columnar_cache(cache_path):
+    # Memory-mapped read: the table references the file pages instead of copying them into the heap.
+    source = pa.memory_map(cache_path, 'r')
+    return pa.ipc.open_file(source).read_all()
+
+def columnar_cache_file(path, dtypes):
+    # Path of the typed Arrow copy of the source, building it first if the source changed since the last build.
+    cache_path = columnar_cache_path(path)
+    if not os.path.exists(cache_path):
+        cache_path = build_columnar_cache(path, dtypes)
+    return cache_path
+
+def columnar_manifest(path, dtypes):
+    # Manifest of the current columnar copy. Copies built before manifests existed get one on first use.
+    cache_path = columnar_cache_file(path, dtypes)
+    if not os.path.exists(manifest_path(cache_path)):
+        table = read_columnar_cache(cache_path)
+        write_manifest(manifest_path(cache_path), build_manifest(table, table.schema.metadata[b'source_sha256'].decode()))
+    return read_manifest(manifest_path(cache_path))
+
+def read_csv_table(path, dtypes, columns=None):
+    table = read_columnar_cache(columnar_cache_file(path, dtypes))
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+def partitioned_dataset_path(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{name}-{source_fingerprint(path)}.parquet")
+
+def build_partitioned_dataset(path, dtypes):
+    # Hive-partitioned Parquet copy of the source, one directory per created_at month, rows sorted by created_at.
+    table = read_csv_table(path, dtypes)
+    table = table.sort_by('created_at')
+    table = table.append_column('year', pc.year(table.column('created_at')).cast(pa.int32()))
+    table = table.append_column('month', pc.month(table.column('created_at')).cast(pa.int32()))
+
+    # Written to a temp directory that is renamed into place, so readers never see a partial dataset.
+    dataset_path = partitioned_dataset_path(path)
+    tmp_path = f"{dataset_path}.{os.getpid()}.tmp"
+    ds.write_dataset(table, tmp_path, format='parquet', partitioning=partitioning,
+                     max_rows_per_group=row_group_rows, min_rows_per_group=row_group_rows)
+    try:
+        os.rename(tmp_path, dataset_path)
+    except OSError:
+        # Another process published the same version first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    # Drop datasets built from older versions of the same source.
+    prefix = os.path.basename(dataset_path).rsplit('-', 2)[0] + '-'
+    for name in os.listdir(cache_dir):
+        stale = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and name.endswith('.parquet') and stale != dataset_path:
+            shutil.rmtree(stale, ignore_errors=True)
+
+    return dataset_path
+
+def partitioned_dataset_file(path, dtypes):
+    # Path of the partitioned Parquet copy, building it first if the source changed since the last build.
+    dataset_path = partitioned_dataset_path(path)
+    if not os.path.exists(dataset_path):
+        dataset_path = build_partitioned_dataset(path, dtypes)
+    return dataset_path
+
+def day_after(date):
+    # Start of the day following date. End dates are inclusive, so ranges compare created_at < day_after(end_date).
+    return pd.Timestamp(date).normalize() + pd.Timedelta(days=1)
+
+def read_partitioned_table(path, dtypes, columns=None, start_date=None, end_date=None):
+    # Only the month partitions overlapping [start_date, end_date] are opened, and within them only the
+    # row groups whose created_at statistics overlap the range and only the requested columns are read.
+    dataset = ds.dataset(partitioned_dataset_file(path, dtypes), format='parquet', partitioning=partitioning)
+    created_at = ds.field('created_at')
+    partition_month = ds.field('year') * 12 + ds.field('month')
+
+    conditions = []
+    if start_date is not None:
+        start = pd.Timestamp(start_date)
+        conditions += [partition_month >= start.year * 12 + start.month,
+                       created_at >= pa.scalar(start, type=pa.timestamp('ns'))]
+    if end_date is not None:
+        end = day_after(end_date)
+        conditions += [partition_month <= end.year * 12 + end.month,
+                       created_at < pa.scalar(end, type=pa.timestamp('ns'))]
+
+    condition = None
+    for part in conditions:
+        condition = part if condition is None else condition & part
+    return dataset.to_table(columns=columns or list(dtypes), filter=condition)
+
+def record_batches_to_ipc(batches, compression='lz4'):
+    # Serializes record batches as they arrive into one compressed Arrow IPC stream,
+    # so results can be cached as bytes without materializing Python row objects.
+    sink = pa.BufferOutputStream()
+    writer = None
+    for batch in batches:
+        if writer is None:
+            writer = pa.ipc.new_stream(sink, batch.schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+        writer.write_batch(batch)
+
+    # An empty result still needs a valid stream to read back.
+    if writer is None:
+        writer = pa.ipc.new_stream(sink, pa.schema([]))
+    writer.close()
+
+    return sink.getvalue().to_pybytes()
+
+def ipc_to_table(buffer):
+    return pa.ipc.open_stream(pa.py_buffer(buffer)).read_all()
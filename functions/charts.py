@@ -0,0 +1,98 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+# Helpers for the Plotly figures in pages/billing_report.py.
+
+# Trend charts label at most this many points; longer series label every k-th point and the last.
+max_point_labels = 24
+
+# Chart data is reduced to what a page_width pixel wide page can show: about one time series point per
+# points_px pixels and one category bar per bar_px pixels of chart width. The server never learns the
+# browser's width (Streamlit sends no Accept-CH, so no viewport client hints arrive), so set page_width to
+# the widest layout the report is viewed at.
+page_width = 1400
+points_px = 2
+bar_px = 40
+min_bars = 5
+
+def label_mask(count, max_labels=max_point_labels):
+    # Evenly spaced points to label, always including the first and last.
+    if count <= max_labels:
+        return np.ones(count, dtype=bool)
+    step = -(-(count - 1) // (max_labels - 1))
+    mask = np.zeros(count, dtype=bool)
+    mask[::step] = True
+    mask[-1] = True
+    return mask
+
+def add_point_labels(fig, x, y, labels, max_labels=max_point_labels):
+    # One text trace labelling the points of a trend, instead of one layout annotation per point:
+    # a single trace to validate and serialize, holding only the labelled points.
+    mask = label_mask(len(x), max_labels)
+    fig.add_trace(go.Scatter(
+        x=np.asarray(x)[mask],
+        y=np.asarray(y)[mask],
+        text=np.asarray(labels)[mask],
+        mode='text',
+        textposition='top center',
+        textfont=dict(color='black', size=10),
+        showlegend=False,
+        hoverinfo='skip',
+    ))
+    return fig
+
+def max_points(columns=1):
+    # Time series points worth sending for a chart in one of columns equal page columns.
+    return max(page_width // (columns * points_px), 3)
+
+def max_bars(columns=1):
+    return max(page_width // (columns * bar_px), min_bars)
+
+def lttb_indices(y, threshold, x=None):
+    # Largest-triangle-three-buckets: positions of threshold points that keep the series' shape.
+    # The first and last points are kept; of every bucket in between, the point forming the largest
+    # triangle with the point kept before it and the average of the next bucket. x defaults to positions.
+    count = len(y)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    y = np.nan_to_num(np.asarray(y, dtype='float64'))
+    x = np.arange(count, dtype='float64') if x is None else np.asarray(x, dtype='float64')
+
+    edges = np.linspace(1, count - 1, threshold - 1).astype('int64')
+    kept = np.empty(threshold, dtype='int64')
+    kept[0], kept[-1] = 0, count - 1
+    for bucket in range(threshold - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        next_hi = edges[bucket + 2] if bucket + 2 < len(edges) else count
+        next_x, next_y = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+        prev = kept[bucket]
+        area = np.abs((x[prev] - next_x) * (y[lo:hi] - y[prev]) - (x[prev] - x[lo:hi]) * (next_y - y[prev]))
+        kept[bucket + 1] = lo + area.argmax()
+    return kept
+
+def downsample(frame, y, max_points, x=None):
+    # frame reduced to at most max_points rows with LTTB on column y (x: a numeric or datetime column,
+    # else rows are taken as evenly spaced, as the report's monthly and daily series are).
+    if len(frame) <= max_points:
+        return frame
+    x_values = frame[x].to_numpy('int64' if frame[x].dtype.kind == 'M' else 'float64') if x else None
+    return frame.iloc[lttb_indices(frame[y].to_numpy(), max_points, x_values)]
+
+def top_categories(frame, category, value, max_bars, other='Other'):
+    # The largest max_bars - 1 categories by value, the rest summed into one other bar; sorted descending.
+    frame = frame.sort_values(value, ascending=False)
+    if len(frame) <= max_bars:
+        return frame
+    top = frame.head(max_bars - 1)
+    rest = pd.DataFrame({category: [other], value: [frame[value].iloc[max_bars - 1:].sum()]})
+    return pd.concat([top.astype({category: str}), rest], ignore_index=True)
+
+# Built figures, shared read-only by every session (st.plotly_chart serializes a copy and never changes them).
+# Keyed on the chart, dataset version, date range, the selections the chart depends on and the point or
+# bar limit its data was reduced to, so reruns that don't change them reuse the figure; _build (the function
+# that builds it) is not hashed. The least recently used figures are evicted past max_entries.
+@st.cache_resource(max_entries=64, show_spinner=False)
+def cached_figure(chart, version, start_date, end_date, category=None, selected_item=None, limit=None, _build=None):
+    return _build()
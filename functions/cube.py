@@ -0,0 +1,64 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+from functions.cache import day_after
+
+# Daily revenue cube shared by every section of pages/billing_report.py. It is built once per dataset
+# version and sorted by day, so a date range is a slice of it and its monthly series roll up the cells in
+# range rather than the line items.
+cube_dimensions = ['day', 'product_type', 'product_name', 'billing_type', 'currency']
+cube_measures = ['total_amount',
+                 'discount_amount',
+                 'refund_amount',
+                 'tax_amount',
+                 'fee_amount',
+                 'subscription_amount',
+                 'line_count',
+                 'subscription_line_count'
+                 ]
+
+def build_revenue_cube(data):
+    # One scan over the line items: additive measures per cell, plus each cell's month ('YYYY-MM').
+    is_subscription = data['subscription_id'].notna()
+    frame = pd.DataFrame({
+        'day': data['created_at'].dt.normalize(),
+        'product_type': data['product_type'],
+        'product_name': data['product_name'],
+        'billing_type': data['billing_type'],
+        'currency': data['currency'],
+        'total_amount': data['total_amount'],
+        'discount_amount': data['discount_amount'],
+        'refund_amount': data['refund_amount'],
+        'tax_amount': data['tax_amount'],
+        'fee_amount': data['fee_amount'],
+        'subscription_amount': data['total_amount'].where(is_subscription, 0),
+        'line_count': 1,
+        'subscription_line_count': is_subscription.astype('int64'),
+    })
+
+    cube = frame.groupby(cube_dimensions, sort=True, dropna=False, observed=True)[cube_measures].sum().reset_index()
+    cube['month'] = cube['day'].dt.to_period('M').astype(str)
+    return cube
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def revenue_cube(version, _data):
+    # Built once per dataset version and shared read-only by every session; _data is not hashed.
+    return build_revenue_cube(_data)
+
+def cube_range(cube, start, end):
+    # Cells for the days between start and end (inclusive); the cube is sorted by day, so two binary searches.
+    days = cube['day'].to_numpy()
+    lo = days.searchsorted(np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+    hi = days.searchsorted(np.datetime64(day_after(end), 'ns'), side='left')
+    return cube.iloc[lo:hi]
+
+def cube_slice(cube, **filters):
+    # Rows of the cube matching every dimension == value filter.
+    mask = np.ones(len(cube), dtype=bool)
+    for dimension, value in filters.items():
+        mask &= (cube[dimension] == value).to_numpy()
+    return mask
+
+def cube_totals(cube, by, **filters):
+    # Measures summed by the given dimension(s) over the filtered slice.
+    return cube[cube_slice(cube, **filters)].groupby(by, observed=True)[cube_measures].sum()
@@ -0,0 +1,166 @@
+import streamlit as st
+import pandas as pd
+import duckdb
+from datetime import datetime
+from functions.report import metrics_from_aggregates
+from functions.subscriptions import month_range
+from functions.cache import day_after
+
+# In-process DuckDB engine for pages/billing_report.py. The loaded line items (the shared frame from
+# query_results) are scanned in place by DuckDB's vectorized, multi-threaded executor; nothing is copied
+# into the database. Returns the same keys as functions.report.report_metrics.
+
+# Line items in the selected range. created_at bounds are bound as $start and $end on every query.
+items = "(select * from line_items where created_at >= $start and created_at < $end)"
+
+# One in-process database per process. Each report runs on its own cursor, so sessions never share
+# a connection (or a registered frame) between threads.
+@st.cache_resource(show_spinner=False)
+def duckdb_connection():
+    return duckdb.connect()
+
+def fetch(cursor, query, params):
+    return cursor.execute(query, params).df()
+
+def month_ordinal(column):
+    # Months since year 0, as in functions.subscriptions.month_ordinal.
+    return f"(year({column}) * 12 + month({column}) - 1)"
+
+def range_totals(cursor, params):
+    return fetch(cursor, f"""
+        select coalesce(sum(total_amount), 0) as total_amount,
+               sum(discount_amount) as discount_amount,
+               sum(refund_amount) as refund_amount,
+               count(*) as line_count,
+               min(created_at) as min_created_at,
+               max(created_at) as max_created_at,
+               min(created_at) filter (where subscription_id is not null) as min_subscription_created_at,
+               max(created_at) filter (where subscription_id is not null) as max_subscription_created_at,
+               -- Line items without a subscription are counted as one group
+               count(distinct subscription_id) + max(case when subscription_id is null then 1 else 0 end) as subscriptions_total,
+               avg(total_amount) filter (where header_status in ('paid', 'completed')) as payments_total
+        from {items}
+    """, params).iloc[0]
+
+def monthly_totals(cursor, params):
+    # Revenue, subscription revenue and distinct customers per created_at month ('YYYY-MM').
+    return fetch(cursor, f"""
+        select strftime(created_at, '%Y-%m') as month,
+               coalesce(sum(total_amount), 0) as total_amount,
+               coalesce(sum(total_amount) filter (where subscription_id is not null), 0) as subscription_amount,
+               count(distinct customer_id) as customer_count
+        from {items}
+        group by 1
+        order by 1
+    """, params).set_index('month')
+
+def subscription_counts(cursor, params, max_created_at):
+    # Distinct subscriptions still running after the last day with line items and ending in the
+    # current month, and distinct subscriptions that ended on or before it.
+    return fetch(cursor, f"""
+        select count(distinct subscription_id) filter (
+                   where subscription_period_ended_at > $max_created_at
+                     and month(subscription_period_ended_at) = $current_month
+               ) as active_subscriptions_count_current_month,
+               count(distinct subscription_id) filter (
+                   where subscription_period_ended_at <= $max_created_at
+               ) as canceled_subscriptions_count
+        from {items}
+    """, {**params, 'max_created_at': max_created_at, 'current_month': datetime.now().month}).iloc[0]
+
+def subscription_events(cursor, params, first_month, month_count):
+    # Subscription periods are merged per subscription (as in functions.subscriptions.merge_periods) and
+    # turned into +1/-1 month events in SQL, counted per month index.
+    events = fetch(cursor, f"""
+        with periods as (
+            -- Open-ended periods stay active through the last month in range.
+            select distinct subscription_id,
+                   least(greatest({month_ordinal('subscription_period_started_at')} - $first_month, 0), $month_count) as started_idx,
+                   least(greatest(coalesce({month_ordinal('subscription_period_ended_at')} - $first_month, $month_count) + 1, 0), $month_count) as ended_idx
+            from {items}
+            where subscription_id is not null and subscription_period_started_at is not null
+        ), reach as (
+            -- Furthest end of the subscription's earlier periods
+            select *, max(ended_idx) over (partition by subscription_id order by started_idx, ended_idx
+                                           rows between unbounded preceding and 1 preceding) as previous_reach
+            from periods
+            where started_idx < ended_idx
+        ), numbered as (
+            -- A period starting after every earlier one has ended starts a new interval
+            select *, sum(case when previous_reach is null or started_idx > previous_reach then 1 else 0 end)
+                          over (partition by subscription_id order by started_idx, ended_idx rows unbounded preceding) as interval_id
+            from reach
+        ), events as (
+            select min(started_idx) as started_idx, max(ended_idx) as ended_idx
+            from numbered
+            group by subscription_id, interval_id
+        )
+        select 'started' as event, started_idx as idx, count(*) as event_count from events group by 2
+        union all
+        select 'ended' as event, ended_idx as idx, count(*) as event_count from events group by 2
+    """, {**params, 'first_month': first_month, 'month_count': month_count})
+
+    started = events[events['event'] == 'started'].rename(columns={'idx': 'started_idx'})
+    ended = events[events['event'] == 'ended'].rename(columns={'idx': 'ended_idx'})
+    return started, ended
+
+def product_revenue(cursor, params):
+    return fetch(cursor, f"""
+        select product_type, product_name, strftime(created_at, '%Y-%m') as month, coalesce(sum(total_amount), 0) as total_amount
+        from {items}
+        group by all
+        order by all
+    """, params)
+
+def customer_lifetime_value(cursor, params):
+    return fetch(cursor, f"""
+        -- Missing totals add nothing; a customer with none still counts, with 0 (as pandas sums)
+        select customer_name, coalesce(sum(total_amount), 0) as CLV
+        from {items}
+        where customer_name is not null
+        group by 1
+        order by 1
+    """, params)
+
+def customer_counts(cursor, params, max_date):
+    # Churned customers (no line item in the last 3 months) and customers active in the month before max_date.
+    churn_cutoff = pd.Timestamp.now(tz='UTC').tz_localize(None) - pd.DateOffset(months=3)
+    counts = fetch(cursor, f"""
+        with last_transaction as (
+            select customer_id, max(created_at) as last_created_at
+            from {items}
+            where customer_id is not null
+            group by 1
+        )
+        select count(*) filter (where last_created_at < $churn_cutoff) / count(*) as churn_rate,
+               (select count(distinct customer_id) from {items} where created_at >= $active_since) as current_active_customer_count
+        from last_transaction
+    """, {**params, 'churn_cutoff': churn_cutoff.to_pydatetime(), 'active_since': (max_date - pd.DateOffset(months=1)).to_pydatetime()})
+    return counts.iloc[0]
+
+def report_metrics(data, start_date, end_date):
+    cursor = duckdb_connection().cursor()
+    try:
+        cursor.register('line_items', data)
+        params = {'start': pd.Timestamp(start_date).to_pydatetime(),
+                  'end': day_after(end_date).to_pydatetime()}
+
+        totals = range_totals(cursor, params)
+        max_created_at = pd.Timestamp(totals['max_created_at']).normalize()
+        months, first_month = month_range(pd.Timestamp(totals['min_created_at']).to_period('M'),
+                                          pd.Timestamp(totals['max_created_at']).to_period('M'))
+        started, ended = subscription_events(cursor, params, first_month, len(months))
+
+        return metrics_from_aggregates(start_date, end_date,
+                                       {**totals,
+                                        **subscription_counts(cursor, params, max_created_at.to_pydatetime()),
+                                        **customer_counts(cursor, params, max_created_at)},
+                                       monthly_totals(cursor, params), months, started, ended,
+                                       product_revenue(cursor, params), customer_lifetime_value(cursor, params))
+    finally:
+        cursor.close()
+
+# Metrics per dataset version and date range; _data (the loaded line items) is not hashed.
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_report_metrics(version, start_date, end_date, _data):
+    return report_metrics(_data, start_date, end_date)
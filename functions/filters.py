@@ -1,16 +1,15 @@
 import streamlit as st
 from datetime import datetime, timedelta
-from functions.query import query_results
+from functions.cache import day_after
+from functions.query import query_results, created_at_bounds, pushes_down_aggregates, use_warehouse, partition_local_data
+import numpy as np
 import pandas as pd
 
-def date_filter(destination="BigQuery"):
+def date_filter(destination="BigQuery", columns=None):
     dest = destination
 
-    data = query_results(destination=dest)
-
     # Extract the minimum and maximum date from your data
-    min_created_at = data['created_at'].min()
-    max_created_at = data['created_at'].max()
+    min_created_at, max_created_at = created_at_bounds(destination=dest)
 
     # Compute start of the two-week period (last year from max created_at)
     start_of_year = max_created_at - timedelta(days=365)
@@ -36,9 +35,26 @@ def date_filter(destination="BigQuery"):
     # Update the session state with the selected dates
     st.session_state.start_date, st.session_state.end_date = date_range
 
-    return data, date_range
+    # Push the selected range into the warehouse query, or into the read of the local sample's month partitions.
+    # Without partition_local_data the sample is loaded in full and filtered with filter_data.
+    # When the report is aggregated at the source no line items are loaded at all (data and version are None).
+    # version is the data_version of the loaded line items.
+    if pushes_down_aggregates(dest):
+        data, version = None, None
+    elif use_warehouse or partition_local_data:
+        data, version = query_results(destination=dest, start_date=date_range[0], end_date=date_range[1], columns=columns)
+    else:
+        data, version = query_results(destination=dest, columns=columns)
+
+    return data, date_range, version
 
 def filter_data(start, end, data_ref):
-    data_date_filtered = data_ref.query("`created_at` >= @start and `created_at` <= @end")
+    # Line items come from query_results sorted by created_at, so the range is two binary searches
+    # and the result is a positional slice sharing the loaded buffers.
+    # created_at is a timestamp, so the end date includes the whole day.
+    created_at = data_ref['created_at'].to_numpy()
+    lo = created_at.searchsorted(np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+    hi = created_at.searchsorted(np.datetime64(day_after(end), 'ns'), side='left')
+    data_date_filtered = data_ref.iloc[lo:hi]
 
     return data_date_filtered
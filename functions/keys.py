@@ -0,0 +1,35 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# UUID-like key columns. They are held as integer codes into one dictionary per column
+# instead of one Python string per row. The dictionary is an Arrow string array, so pandas only
+# decodes the values a display actually shows (e.g. the schema table).
+key_columns = ['header_id',
+               'line_item_id',
+               'payment_id',
+               'payment_method_id',
+               'subscription_id',
+               'customer_id'
+               ]
+
+def encode_keys(values):
+    # Arrow array/chunked array (or anything pa.array accepts) -> pandas Categorical with Arrow-backed categories.
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    elif not isinstance(values, pa.Array):
+        values = pa.array(values, type=pa.string(), from_pandas=True)
+
+    return categorical_from_dictionary(values.cast(pa.string()).dictionary_encode())
+
+def categorical_from_dictionary(encoded, arrow_categories=True):
+    # Arrow dictionary array -> pandas Categorical. Codes are only copied when there are nulls to mark as -1.
+    # With arrow_categories the categories stay in the Arrow dictionary buffer instead of becoming Python strings.
+    indices = encoded.indices
+    codes = pc.fill_null(indices, -1).to_numpy() if indices.null_count else indices.to_numpy()
+    if arrow_categories:
+        categories = pd.Index(pd.arrays.ArrowStringArray(encoded.dictionary))
+    else:
+        categories = pd.Index(encoded.dictionary.to_pandas())
+
+    return pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(categories))
@@ -0,0 +1,58 @@
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Dataset manifest: a summary of the line items small enough to read on every rerun, so the date slider
+# and product selectors render before (or without) loading the line items themselves.
+# {'row_count': int,
+#  'timestamps': {column: [min iso timestamp, max iso timestamp]},
+#  'product_types': [...], 'product_names': [...], 'currencies': [...],
+#  'content_hash': sha256 of the source file, or None for warehouse tables}
+
+# Manifest key -> line item column whose distinct values it lists.
+distinct_columns = {'product_types': 'product_type',
+                    'product_names': 'product_name',
+                    'currencies': 'currency'
+                    }
+
+def iso_timestamp(value):
+    return None if value is None or pd.isna(value) else pd.Timestamp(value).isoformat()
+
+def build_manifest(table, content_hash=None):
+    # Arrow table -> manifest. Distinct values keep their order of first appearance, the same order
+    # the loaded categoricals use.
+    timestamps = {}
+    for field in table.schema:
+        if pa.types.is_timestamp(field.type):
+            bounds = pc.min_max(table.column(field.name))
+            timestamps[field.name] = [iso_timestamp(bounds['min'].as_py()), iso_timestamp(bounds['max'].as_py())]
+
+    manifest = {'row_count': table.num_rows, 'timestamps': timestamps}
+    for key, col in distinct_columns.items():
+        manifest[key] = pc.unique(table.column(col)).drop_null().to_pylist()
+    manifest['content_hash'] = content_hash
+
+    return manifest
+
+def manifest_from_row(row, timestamp_columns):
+    # Manifest from one warehouse aggregate row with row_count, <column>_min / <column>_max per
+    # timestamp column and one array per distinct_columns key.
+    return {
+        'row_count': int(row['row_count']),
+        'timestamps': {col: [iso_timestamp(row[f'{col}_min']), iso_timestamp(row[f'{col}_max'])] for col in timestamp_columns},
+        **{key: list(row[key]) for key in distinct_columns},
+        'content_hash': None,
+    }
+
+def write_manifest(manifest_path, manifest):
+    # Temp file + rename, like the columnar cache it describes.
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+def read_manifest(manifest_path):
+    with open(manifest_path) as f:
+        return json.load(f)
@@ -0,0 +1,169 @@
+import os
+import streamlit as st
+import pandas as pd
+import polars as pl
+from datetime import datetime
+from functions.report import metrics_from_aggregates
+from functions.subscriptions import month_range
+from functions.cache import day_after
+
+# Polars lazy engine for pages/billing_report.py. The report is one lazy query plan over a scan of
+# the line items, so the date range filter and the handful of columns it needs are pushed down into
+# the scan itself. Returns the same keys as functions.report.report_metrics.
+
+# Columns the report reads; everything else is never read from the source.
+scan_columns = ['created_at',
+                'header_status',
+                'product_name',
+                'product_type',
+                'discount_amount',
+                'total_amount',
+                'refund_amount',
+                'subscription_id',
+                'subscription_period_started_at',
+                'subscription_period_ended_at',
+                'customer_id',
+                'customer_name'
+                ]
+
+# Missing values count as 0, as in functions.query.zero_filled_columns.
+zero_filled_columns = ['discount_amount', 'refund_amount']
+
+def scan_line_items(source, start_date=None, end_date=None):
+    # source is the path of an Arrow IPC file or a hive-partitioned Parquet directory (scanned lazily; month
+    # partitions outside [start_date, end_date] are never opened and row groups outside the date range are
+    # skipped using their created_at statistics) or an Arrow table (e.g. a warehouse result). Timestamps are
+    # made tz-naive UTC and missing amounts 0, as in functions.query.normalize_line_items.
+    if isinstance(source, str) and os.path.isdir(source):
+        scan = pl.scan_parquet(os.path.join(source, '**', '*.parquet'), hive_partitioning=True)
+        # As in functions.cache.read_partitioned_table.
+        partition_month = pl.col('year') * 12 + pl.col('month')
+        if start_date is not None:
+            start = pd.Timestamp(start_date)
+            scan = scan.filter(partition_month >= start.year * 12 + start.month)
+        if end_date is not None:
+            end = day_after(end_date)
+            scan = scan.filter(partition_month <= end.year * 12 + end.month)
+    elif isinstance(source, str):
+        scan = pl.scan_ipc(source)
+    else:
+        scan = pl.from_arrow(source).lazy()
+    schema = scan.collect_schema()
+
+    timestamps = [col for col in scan_columns if isinstance(schema[col], pl.Datetime)]
+    return scan.select(scan_columns).with_columns(
+        *[pl.col(col).dt.convert_time_zone('UTC').dt.replace_time_zone(None).dt.cast_time_unit('ns')
+          if schema[col].time_zone is not None else pl.col(col).dt.cast_time_unit('ns')
+          for col in timestamps],
+        *[pl.col(col).fill_null(0).fill_nan(0) for col in zero_filled_columns],
+    )
+
+def month_ordinal(column):
+    # Months since year 0, as in functions.subscriptions.month_ordinal.
+    return pl.col(column).dt.year().cast(pl.Int64) * 12 + pl.col(column).dt.month().cast(pl.Int64) - 1
+
+def to_pandas(frame):
+    return frame.to_pandas(use_pyarrow_extension_array=False)
+
+def range_totals(items):
+    is_subscription = pl.col('subscription_id').is_not_null()
+    max_day = pl.col('created_at').max().dt.truncate('1d')
+    ended_at = pl.col('subscription_period_ended_at')
+    return items.select(
+        total_amount=pl.col('total_amount').sum(),
+        discount_amount=pl.col('discount_amount').sum(),
+        refund_amount=pl.col('refund_amount').sum(),
+        line_count=pl.len(),
+        min_created_at=pl.col('created_at').min(),
+        max_created_at=pl.col('created_at').max(),
+        min_subscription_created_at=pl.col('created_at').filter(is_subscription).min(),
+        max_subscription_created_at=pl.col('created_at').filter(is_subscription).max(),
+        # Line items without a subscription are counted as one group
+        subscriptions_total=pl.col('subscription_id').n_unique(),
+        payments_total=pl.col('total_amount').filter(pl.col('header_status').is_in(['paid', 'completed'])).mean(),
+        # Distinct subscriptions still running after the last day with line items and ending in the
+        # current month, and distinct subscriptions that ended on or before it.
+        active_subscriptions_count_current_month=pl.col('subscription_id').filter(
+            (ended_at > max_day) & (ended_at.dt.month() == datetime.now().month)
+        ).drop_nulls().n_unique(),
+        canceled_subscriptions_count=pl.col('subscription_id').filter(ended_at <= max_day).drop_nulls().n_unique(),
+        # Customers active in the month before the last day with line items
+        current_active_customer_count=pl.col('customer_id').filter(
+            pl.col('created_at') >= max_day.dt.offset_by('-1mo')
+        ).drop_nulls().n_unique(),
+    )
+
+def monthly_totals(items):
+    # Revenue, subscription revenue and distinct customers per created_at month ('YYYY-MM').
+    return items.group_by(month=pl.col('created_at').dt.strftime('%Y-%m')).agg(
+        total_amount=pl.col('total_amount').sum(),
+        subscription_amount=pl.col('total_amount').filter(pl.col('subscription_id').is_not_null()).sum(),
+        customer_count=pl.col('customer_id').drop_nulls().n_unique(),
+    ).sort('month')
+
+def subscription_events(items, first_month, month_count):
+    # Subscription periods merged per subscription (as in functions.subscriptions.merge_periods) and
+    # turned into +1/-1 month events, counted per month index.
+    # Open-ended periods stay active through the last month in range.
+    ended = month_ordinal('subscription_period_ended_at').fill_null(first_month + month_count)
+    periods = items.filter(
+        pl.col('subscription_id').is_not_null() & pl.col('subscription_period_started_at').is_not_null()
+    ).select(
+        'subscription_id',
+        started_idx=(month_ordinal('subscription_period_started_at') - first_month).clip(0, month_count),
+        ended_idx=(ended - first_month + 1).clip(0, month_count),
+    ).filter(pl.col('started_idx') < pl.col('ended_idx')).unique().sort('subscription_id', 'started_idx', 'ended_idx')
+
+    # A period starting after every earlier one of its subscription has ended starts a new interval.
+    previous_reach = pl.col('ended_idx').cum_max().shift(1).over('subscription_id')
+    events = periods.with_columns(
+        interval_id=(previous_reach.is_null() | (pl.col('started_idx') > previous_reach)).cast(pl.Int64).cum_sum().over('subscription_id'),
+    ).group_by('subscription_id', 'interval_id').agg(
+        started_idx=pl.col('started_idx').min(),
+        ended_idx=pl.col('ended_idx').max(),
+    )
+
+    return (events.group_by('started_idx').agg(event_count=pl.len()),
+            events.group_by('ended_idx').agg(event_count=pl.len()))
+
+def product_revenue(items):
+    return items.group_by('product_type', 'product_name', month=pl.col('created_at').dt.strftime('%Y-%m')).agg(
+        total_amount=pl.col('total_amount').sum(),
+    ).sort('product_type', 'product_name', 'month')
+
+def customer_lifetime_value(items):
+    return items.filter(pl.col('customer_name').is_not_null()).group_by('customer_name').agg(
+        CLV=pl.col('total_amount').sum(),
+    ).sort('customer_name')
+
+def churn_rate(items):
+    # Share of customers without a line item in the last 3 months.
+    churn_cutoff = pd.Timestamp.now(tz='UTC').tz_localize(None) - pd.DateOffset(months=3)
+    last_transaction = items.filter(pl.col('customer_id').is_not_null()).group_by('customer_id').agg(
+        last_created_at=pl.col('created_at').max(),
+    )
+    return last_transaction.select(churn_rate=(pl.col('last_created_at') < churn_cutoff.to_pydatetime()).mean())
+
+def report_metrics(scan, start_date, end_date):
+    start = pd.Timestamp(start_date).to_pydatetime()
+    end = day_after(end_date).to_pydatetime()
+    items = scan.filter((pl.col('created_at') >= start) & (pl.col('created_at') < end))
+
+    totals = range_totals(items).collect().row(0, named=True)
+    months, first_month = month_range(pd.Timestamp(totals['min_created_at']).to_period('M'),
+                                      pd.Timestamp(totals['max_created_at']).to_period('M'))
+    started_events, ended_events = subscription_events(items, first_month, len(months))
+
+    # The remaining queries share the filtered scan and run in parallel.
+    monthly, products, clv, churn, started, ended = pl.collect_all([
+        monthly_totals(items), product_revenue(items), customer_lifetime_value(items), churn_rate(items),
+        started_events, ended_events,
+    ])
+    return metrics_from_aggregates(start_date, end_date, {**totals, 'churn_rate': churn['churn_rate'][0]},
+                                   to_pandas(monthly).set_index('month'), months, to_pandas(started), to_pandas(ended),
+                                   to_pandas(products), to_pandas(clv))
+
+# Metrics per dataset version and date range; _source (see functions.query.line_item_source) is not hashed.
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_report_metrics(version, start_date, end_date, _source):
+    return report_metrics(scan_line_items(_source, start_date, end_date), start_date, end_date)
@@ -1,7 +1,22 @@
+import hashlib
+import os
+import time
 import streamlit as st
+import numpy as np
 import pandas as pd
 from google.oauth2 import service_account
 from google.cloud import bigquery
+from functions.cache import day_after, read_csv_table, read_partitioned_table, partitioned_dataset_file, columnar_manifest, source_fingerprint, record_batches_to_ipc, ipc_to_table
+from functions.keys import key_columns, encode_keys
+from functions.shared import shared_dataset_name, shared_frame
+from functions.manifest import distinct_columns, manifest_from_row
+from functions.refresh import cached_result, result_status
+from functions.query_cache import query_cache_key, read_cached_query, write_cached_query
+from functions.sync import synced_table_path, read_synced_table, synced_version, sync_line_items, created_at_range
+
+# The loaded dataset is shared across sessions (see shared_line_items). Copy-on-write keeps
+# derived frames and slices from ever writing back into it.
+pd.set_option('mode.copy_on_write', True)
 
 data_columns = ['header_id',
                 'line_item_id',
@@ -39,46 +54,428 @@ data_columns = ['header_id',
                 'customer_country'
                 ]
 
+# Explicit dtypes for every column so loads never fall back to type inference.
+data_dtypes = {'header_id': 'string',
+               'line_item_id': 'string',
+               'line_item_index': 'Int64',
+               'record_type': 'string',
+               'created_at': 'datetime64[ns]',
+               'currency': 'string',
+               'header_status': 'string',
+               'product_id': 'Int64',
+               'product_name': 'string',
+               'transaction_type': 'string',
+               'billing_type': 'string',
+               'product_type': 'string',
+               'quantity': 'Int64',
+               'unit_amount': 'float64',
+               'discount_amount': 'float64',
+               'tax_amount': 'float64',
+               'total_amount': 'float64',
+               'payment_id': 'string',
+               'payment_method_id': 'string',
+               'payment_method': 'string',
+               'payment_at': 'datetime64[ns]',
+               'fee_amount': 'float64',
+               'refund_amount': 'float64',
+               'subscription_id': 'string',
+               'subscription_period_started_at': 'datetime64[ns]',
+               'subscription_period_ended_at': 'datetime64[ns]',
+               'subscription_status': 'string',
+               'customer_id': 'string',
+               'customer_level': 'string',
+               'customer_name': 'string',
+               'customer_company': 'string',
+               'customer_email': 'string',
+               'customer_city': 'string',
+               'customer_country': 'string'
+               }
+
+data_path = 'data/dunder_mifflin__line_item_enhanced.csv'
+
+# Columns read by pages/billing_report.py. Warehouse queries only select what the page uses.
+report_columns = ['header_status',
+                  'created_at',
+                  'product_name',
+                  'product_type',
+                  'billing_type',
+                  'currency',
+                  'discount_amount',
+                  'tax_amount',
+                  'total_amount',
+                  'fee_amount',
+                  'refund_amount',
+                  'subscription_id',
+                  'subscription_period_started_at',
+                  'subscription_period_ended_at',
+                  'customer_id',
+                  'customer_name'
+                  ]
+
+timestamp_columns = [col for col, dtype in data_dtypes.items() if dtype.startswith('datetime64')]
+# Amounts the report sums with missing values as 0. Other amounts stay NaN, so averages skip them.
+zero_filled_columns = ['discount_amount', 'refund_amount']
+
+# Low-cardinality text columns, held as pandas categoricals.
+categorical_columns = ['record_type',
+                       'currency',
+                       'header_status',
+                       'product_name',
+                       'transaction_type',
+                       'billing_type',
+                       'product_type',
+                       'payment_method',
+                       'subscription_status',
+                       'customer_level',
+                       'customer_company',
+                       'customer_country'
+                       ]
+
 columns_str = ', '.join(data_columns)
 quoted_columns = [f'{col}' for col in data_columns]
 
 schema = 'add_schema_here'
 platform = 'add_platform_here'
 
-# Perform query.
-# Uses st.cache_data to only rerun when the query changes or after 10 min.
-# Only used for local testing. Once deployed this will not be used and instead will use the fake data.
-@st.cache_data(ttl=600)
-def run_query(query):
+# Set to True to read line items from the warehouse instead of the bundled sample CSV.
+use_warehouse = False
+
+# Warehouse the pages read from when use_warehouse is set: "BigQuery" or "Snowflake".
+# With Snowflake the billing report aggregations run in the warehouse (functions.snowflake_engine, imported
+# only when Snowflake is used, since Snowpark takes about a second to import).
+warehouse = "BigQuery"
+
+# BigQuery results (and syncs of the local copy, with sync_warehouse) are served stale-while-revalidate
+# (functions.refresh): once a result is this many seconds old it is re-run in the background and swapped in
+# when done, so after the first load of a query no viewer waits on the warehouse.
+refresh_after = 480
+
+# Set to True to also keep BigQuery results on local disk (functions.query_cache), so restarts and new
+# replicas serve the last result while refreshing instead of waiting on the warehouse, and the worker
+# processes of a node take each other's refreshes instead of each re-running the query. Results are evicted
+# least recently used first beyond query_cache_bytes; bump query_cache_version to drop every saved result
+# (e.g. after the line_item_enhanced model changes).
+use_query_cache = True
+query_cache_bytes = 2 * 2**30
+query_cache_version = '1'
+
+# Set to True (with BigQuery) to keep an incremental local copy of the line item table (functions.sync)
+# instead of re-running the full query when cached results expire. Refreshes fetch only line items
+# created within sync_lookback of the newest synced created_at and merge them in by line_item_id.
+sync_warehouse = False
+sync_lookback = pd.Timedelta(days=7)
+
+# Engine computing the billing report: "pandas" (shared daily index and revenue cube, functions.report),
+# "duckdb" (SQL over the loaded frame, functions.duckdb_engine) or "polars" (a lazy scan of the source with the
+# date range and columns pushed down, functions.polars_engine). Ignored when the warehouse is Snowflake.
+report_engine = "pandas"
+
+# Set to True to read date ranges of the local sample from its month-partitioned Parquet copy
+# (functions.cache.partitioned_dataset_file), so a range only reads the months it overlaps. Each range
+# is then its own dataset, loaded and indexed again, so this only pays off for local files too large to
+# load in full. With False (the default, right for the bundled sample) the sample is loaded once and
+# every range is answered from the shared daily index and filter_data's binary search. The Polars engine
+# scans the partitioned copy either way, since its scan prunes months without loading anything.
+partition_local_data = False
+
+# Set to True to publish the loaded dataset once per node as a memory-mapped Arrow file
+# (functions.shared.shared_dir) that every Streamlit worker process maps read-only.
+use_shared_memory = False
+
+def line_item_table():
+    return f"{schema}.{platform}__line_item_enhanced"
+
+def line_item_query(columns=None, start_date=None, end_date=None):
+    # Builds the line item select with only the requested columns and created_at bounds as query parameters,
+    # so BigQuery can prune partitions instead of scanning the full history.
+    columns = columns or data_columns
+    unknown = [col for col in columns if col not in data_columns]
+    if unknown:
+        raise ValueError(f"Unknown line_item_enhanced columns: {', '.join(unknown)}")
+
+    conditions = []
+    params = []
+    if start_date is not None:
+        conditions.append('created_at >= @start_date')
+        params.append(('start_date', 'TIMESTAMP', pd.Timestamp(start_date).to_pydatetime()))
+    if end_date is not None:
+        conditions.append('created_at < @end_date')
+        params.append(('end_date', 'TIMESTAMP', day_after(end_date).to_pydatetime()))
+
+    query = f"select {', '.join(columns)}\nfrom {line_item_table()}"
+    if conditions:
+        query += f"\nwhere {' and '.join(conditions)}"
+
+    return query, tuple(params)
+
+def bigquery_client():
     # Create API client.
     credentials = service_account.Credentials.from_service_account_info(
         st.secrets["gcp_service_account"]
     )
-    client = bigquery.Client(credentials=credentials)
-    query_job = client.query(query)
+    return bigquery.Client(credentials=credentials)
+
+def fetch_arrow(client, query, params=()):
+    # params are (name, type, value) tuples. Any client exposing query(sql, job_config=...) whose result()
+    # has to_arrow_iterable() works, so a local stand-in can replace bigquery.Client when testing.
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter(name, type_, value) for name, type_, value in params]
+    )
+    query_job = client.query(query, job_config=job_config)
     rows_raw = query_job.result()
-    # Convert to list of dicts. Required for st.cache_data to hash the return value.
-    rows = [dict(row) for row in rows_raw]
-    return rows
-
-def query_results(destination):
-    ## Commented out as this will only be used for local testing at the moment.
-    # query = run_query(
-    #     f"""select {columns_str}
-    #     from {schema}.{platform}__line_item_enhanced
-    #     """
-    # )
-
-    query = pd.read_csv('data/dunder_mifflin__line_item_enhanced.csv', parse_dates=['created_at', 'payment_at', 'subscription_period_started_at', 'subscription_period_ended_at'])
-    data = pd.DataFrame(query, columns=data_columns)
-
-    # Ensure 'created_at' column is datetime if loaded from CSV
-    if 'created_at' in data.columns and not pd.api.types.is_datetime64_any_dtype(data['created_at']):
-        data['created_at'] = pd.to_datetime(data['created_at'])
-        
+    # Stream result pages as Arrow record batches into compressed IPC bytes.
+    # Bytes are cheap for st.cache_data to hash and store, unlike one dict per row.
+    return record_batches_to_ipc(rows_raw.to_arrow_iterable())
+
+def query_result(query, params=()):
+    # Cached result of a query (see functions.refresh): IPC bytes under 'value' and a 'version' hashed from them.
+    # With use_query_cache every fetched result is saved to disk and a process's first use starts from the saved one.
+    disk_key = query_cache_key(query, params, query_cache_version)
+
+    def fetch():
+        buffer = fetch_arrow(bigquery_client(), query, params)
+        if use_query_cache:
+            write_cached_query(disk_key, buffer, query_cache_bytes)
+        return buffer
+
+    return cached_result((query, params), fetch, refresh_after, (lambda: read_cached_query(disk_key)) if use_query_cache else None)
+
+# Perform query.
+# Results are shared by every session and refreshed in the background once refresh_after seconds old.
+def run_query(query, params=()):
+    return query_result(query, params)['value']
+
+def query_table(query, params=(), client=None):
+    # Arrow table for a query, through the shared result cache unless a client is injected.
+    buffer = fetch_arrow(client, query, params) if client is not None else run_query(query, params)
+    return ipc_to_table(buffer)
+
+def fetch_line_items_since(client, since=None):
+    # Every column, so the synced copy can serve any page; bypasses run_query since each watermark is a new query.
+    query, params = line_item_query(data_columns, since)
+    return ipc_to_table(fetch_arrow(client, query, params))
+
+def refresh_synced_line_items(client=None):
+    # Brings the local copy up to date and returns its path.
+    client = client or bigquery_client()
+    return sync_line_items(synced_table_path(line_item_table()), lambda since: fetch_line_items_since(client, since), sync_lookback)
+
+def synced_line_items_version(table):
+    # Version of the synced copy. Syncs are served stale-while-revalidate like query results, so only a
+    # process's first use with no copy on disk yet syncs in the caller.
+    path = synced_table_path(table)
+
+    def saved():
+        if not os.path.exists(path):
+            return None
+        return synced_version(path), os.stat(path).st_mtime
+
+    return cached_result(('sync', table), lambda: synced_version(refresh_synced_line_items()), refresh_after, saved)['value']
+
+def synced_line_items(start_date=None, end_date=None, columns=None, client=None):
+    # Arrow table of the synced line items in range, syncing first if a client is injected or there is no copy yet.
+    path = synced_table_path(line_item_table())
+    if client is not None or not os.path.exists(path):
+        path = refresh_synced_line_items(client)
+    table = created_at_range(read_synced_table(path), start_date, end_date)
+    return table.select(columns or data_columns)
+
+def pushes_down_aggregates(destination):
+    # True when the billing report is aggregated at the source (in Snowflake, or by a Polars scan)
+    # instead of over loaded line items.
+    return (use_warehouse and destination == "Snowflake") or report_engine == "polars"
+
+def result_version(query, params, result):
+    # Version of a query_result: changes when a background refresh swaps in a result with new content.
+    return f"{hashlib.sha256(repr((query, params)).encode()).hexdigest()[:16]}-{result['version']}"
+
+def line_item_source(destination, start_date=None, end_date=None, columns=None):
+    # What functions.polars_engine scans, and its data_version: the month-partitioned Parquet copy of the local
+    # sample (read lazily, so the date range prunes partitions and row groups and only the columns used are read),
+    # or the cached Arrow result of the ranged warehouse query.
+    if use_warehouse and destination == "BigQuery" and sync_warehouse:
+        version = data_version(destination, start_date, end_date, columns)
+        return synced_line_items(start_date, end_date, columns), version
+    if use_warehouse and destination == "BigQuery":
+        # Table and version from the same result, so a swap in between can't pair them up wrongly.
+        query, params = line_item_query(columns, start_date, end_date)
+        result = query_result(query, params)
+        return ipc_to_table(result['value']), result_version(query, params, result)
+    return partitioned_dataset_file(data_path, data_dtypes), data_version(destination, start_date, end_date, columns)
+
+def data_version(destination="BigQuery", start_date=None, end_date=None, columns=None):
+    # Identifies the dataset loaded by query_results (which returns it along with the data) so derived
+    # results can be cached per version. columns defaults to report_columns, the ones pages/billing_report.py loads.
+    if use_warehouse and destination == "BigQuery" and sync_warehouse:
+        # The synced copy changes only when a refresh brought in new or changed line items.
+        return f"{synced_line_items_version(line_item_table())}-{start_date}-{end_date}"
+    if use_warehouse and destination == "BigQuery":
+        query, params = line_item_query(columns or report_columns, start_date, end_date)
+        return result_version(query, params, query_result(query, params))
+    if use_warehouse and destination == "Snowflake":
+        query, params = line_item_query(columns or report_columns, start_date, end_date)
+        return f"{hashlib.sha256(repr((query, params)).encode()).hexdigest()[:16]}-{int(time.time() // 600)}"
+    if partition_local_data and (start_date is not None or end_date is not None):
+        # Ranged reads of the partitioned copy return only the range, so each range is its own dataset.
+        return f"{source_fingerprint(data_path)}-{start_date}-{end_date}"
+    return source_fingerprint(data_path)
+
+def data_freshness(destination="BigQuery", start_date=None, end_date=None, columns=None):
+    # Age and last refresh duration of the BigQuery result (or sync) behind query_results, or None for other sources.
+    if not (use_warehouse and destination == "BigQuery"):
+        return None
+    if sync_warehouse:
+        return result_status(('sync', line_item_table()))
+    query, params = line_item_query(columns or report_columns, start_date, end_date)
+    return result_status((query, params))
+
+def manifest_query():
+    # One aggregate row with everything functions.manifest records; no line items are returned.
+    selects = ['count(*) as row_count']
+    for col in timestamp_columns:
+        selects += [f'min({col}) as {col}_min', f'max({col}) as {col}_max']
+    for key, col in distinct_columns.items():
+        selects.append(f'array_agg(distinct {col} ignore nulls order by {col}) as {key}')
+    return f"select {', '.join(selects)}\nfrom {line_item_table()}"
+
+def dataset_manifest(destination="BigQuery", client=None):
+    # Row count, timestamp bounds and distinct products and currencies, without loading any line items.
+    # The local sample's manifest is written with its columnar copy; warehouse manifests are cached for 10 min.
+    if use_warehouse and destination == "BigQuery":
+        return manifest_from_row(query_table(manifest_query(), client=client).to_pylist()[0], timestamp_columns)
+    if use_warehouse and destination == "Snowflake":
+        from functions import snowflake_engine
+        if client is not None:
+            return snowflake_engine.dataset_manifest(client, line_item_table(), timestamp_columns)
+        return snowflake_engine.cached_dataset_manifest(line_item_table(), tuple(timestamp_columns))
+    return columnar_manifest(data_path, data_dtypes)
+
+def created_at_bounds(destination="BigQuery", client=None):
+    # Min and max created_at dates from the dataset manifest.
+    min_created_at, max_created_at = dataset_manifest(destination, client)['timestamps']['created_at']
+    return pd.Timestamp(min_created_at).date(), pd.Timestamp(max_created_at).date()
+
+def normalize_line_items(data):
+    # Single normalization stage so pages can use the frame as-is:
+    # - timestamps are tz-naive UTC datetime64[ns]
+    # - missing discount and refund amounts are 0 (zero_filled_columns)
+    # - low-cardinality text columns are categoricals
+    # - rows are sorted by created_at, so functions.filters.filter_data can binary search date ranges
+    for col in data.columns.intersection(timestamp_columns):
+        timestamps = data[col] if pd.api.types.is_datetime64_any_dtype(data[col]) else pd.to_datetime(data[col], utc=True)
+        if getattr(timestamps.dt, 'tz', None) is not None:
+            timestamps = timestamps.dt.tz_convert('UTC').dt.tz_localize(None)
+        data[col] = timestamps.astype('datetime64[ns]')
+
+    for col in data.columns.intersection(zero_filled_columns):
+        data[col] = data[col].fillna(0)
+
+    for col in data.columns.intersection(categorical_columns):
+        if not isinstance(data[col].dtype, pd.CategoricalDtype):
+            data[col] = data[col].astype('category')
+
+    for col in data.columns.intersection(key_columns):
+        if not isinstance(data[col].dtype, pd.CategoricalDtype):
+            data[col] = encode_keys(data[col])
+
+    # Sorted after the categoricals are built so their category order stays the order of appearance.
+    if 'created_at' in data.columns and not data['created_at'].is_monotonic_increasing:
+        data = data.sort_values('created_at', kind='stable', ignore_index=True)
+
+    return data
+
+def line_items_frame(table, columns):
+    # Arrow table -> pandas. Key columns are dictionary-encoded in Arrow so no per-row strings are created,
+    # and categorical columns are dictionary-encoded during conversion. Only the remaining columns go through to_pandas.
+    keys = [col for col in table.column_names if col in key_columns]
+    data = table.select([col for col in table.column_names if col not in keys]).to_pandas(
+        categories=[col for col in table.column_names if col in categorical_columns]
+    )
+    for col in keys:
+        data[col] = encode_keys(table.column(col))
+
+    return pd.DataFrame(data, columns=columns)
+
+def load_line_items(destination, start_date=None, end_date=None, columns=None, client=None):
+    columns = columns or data_columns
+
+    if use_warehouse and destination == "BigQuery" and sync_warehouse:
+        # Date range and column projection are applied to the synced copy.
+        data = line_items_frame(synced_line_items(start_date, end_date, columns, client), columns)
+    elif use_warehouse and destination == "BigQuery":
+        # Date range and column projection are pushed into the query itself.
+        query, params = line_item_query(columns, start_date, end_date)
+        # The frame is built straight from the Arrow columns.
+        data = line_items_frame(query_table(query, params, client), columns)
+    elif use_warehouse and destination == "Snowflake":
+        # client is a Snowpark session here; the pooled one is used when none is injected.
+        from functions import snowflake_engine
+        data = snowflake_engine.load_line_items(client or snowflake_engine.snowflake_session(), line_item_table(), columns, start_date, end_date)
+    elif partition_local_data and (start_date is not None or end_date is not None):
+        # Only the month partitions overlapping the range and the requested columns are read.
+        data = line_items_frame(read_partitioned_table(data_path, data_dtypes, columns, start_date, end_date), columns)
+    else:
+        # Reads the typed Arrow copy of the CSV, building it first if the source changed since the last load.
+        # Without a range (or partition_local_data) the sample is returned in full; date ranges are then
+        # applied by functions.filters.filter_data.
+        data = line_items_frame(read_csv_table(data_path, data_dtypes, columns), columns)
+
+    return normalize_line_items(data)
+
+# One loaded dataset per process, shared by every session. version changes whenever the source does.
+# With use_shared_memory the dataset is also shared between worker processes on the node.
+@st.cache_resource(max_entries=8, show_spinner=False)
+def shared_line_items(destination, version, start_date, end_date, columns):
+    if use_shared_memory:
+        name = shared_dataset_name(destination, start_date, end_date, columns)
+        return shared_frame(name, version, lambda: load_line_items(destination, start_date, end_date, list(columns)))
+    return load_line_items(destination, start_date, end_date, list(columns))
+
+def frame_nbytes(data):
+    # Bytes referenced by a frame's columns. Object columns count their pointers only, since the
+    # strings themselves are shared with the loaded dataset.
+    return int(data.memory_usage(index=True, deep=False).sum())
+
+def column_buffers(column):
+    # (address, size) of the memory behind a column's values, without copying them. Categoricals count
+    # their codes (the categories belong to the dataset), Arrow-backed columns their Arrow buffers.
+    values = column.array
+    if isinstance(values, pd.Categorical):
+        values = values.codes
+    elif isinstance(column.dtype, (pd.ArrowDtype, pd.StringDtype)) and hasattr(values, '__arrow_array__'):
+        return [(buffer.address, buffer.size) for chunk in values.__arrow_array__().chunks for buffer in chunk.buffers() if buffer is not None]
+    values = np.asarray(values)
+    return [(values.__array_interface__['data'][0], values.nbytes)]
+
+def private_nbytes(data, shared):
+    # Bytes of data's columns that live in memory of their own rather than in shared's buffers:
+    # a slice or shallow copy of the shared dataset counts 0, a filtered copy counts in full.
+    shared_buffers = [buffer for col in shared.columns for buffer in column_buffers(shared[col])]
+    private = int(data.index.memory_usage())
+    for col in data.columns:
+        for address, size in column_buffers(data[col]):
+            if not any(start <= address < start + length for start, length in shared_buffers):
+                private += size
+    return private
+
+def metrics_nbytes(metrics):
+    # Bytes held by a report_metrics result. Its frames are computed (or copied out of st.cache_data)
+    # per run, so they count in full, strings included.
+    return sum(int(value.memory_usage(index=True, deep=True).sum()) for value in metrics.values() if isinstance(value, pd.DataFrame))
+
+def query_results(destination, start_date=None, end_date=None, columns=None, client=None):
+    # (line items, data_version). Pages cache what they derive from the line items under this version rather
+    # than looking it up again, since a background refresh may have swapped in a new result in between.
+    # The version is None when a client is injected, since nothing is cached then.
+    if client is not None:
+        return load_line_items(destination, start_date, end_date, columns, client), None
+
     # Get the data into the app and specify any datatypes if needed.
     data_load_state = st.text('Loading data...')
-    data['created_at'] = data['created_at'].dt.date
-    data_load_state.text("Done! (using st.cache_data)")
+    version = data_version(destination, start_date, end_date, columns or data_columns)
+    data = shared_line_items(destination, version, start_date, end_date, tuple(columns or data_columns))
+    data_load_state.text("Done! (using st.cache_resource)")
 
-    return data
\ No newline at end of file
+    # With copy-on-write, this shallow copy shares every buffer with the cached dataset but
+    # anything a page assigns to it stays private to that page.
+    return data.copy(deep=False), version
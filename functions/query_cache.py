@@ -0,0 +1,86 @@
+import hashlib
+import os
+import threading
+import time
+from functions.cache import cache_dir
+
+# Query results persisted on local disk, so restarted processes and new replicas start warm instead of
+# re-querying the warehouse. Each result is the compressed Arrow IPC stream functions.query.fetch_arrow
+# returns, in one file named after its key. A file's access time records its last use (set explicitly,
+# so it doesn't depend on mount options) and its modification time when the result was fetched.
+# Once the files exceed the byte budget the least recently used ones are removed.
+
+query_cache_dir = os.path.join(cache_dir, 'queries')
+
+# Hits, misses, writes and evictions by this process.
+counters = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+counters_lock = threading.Lock()
+
+def count(name, n=1):
+    with counters_lock:
+        counters[name] += n
+
+def query_cache_key(query, params, version):
+    # Whitespace is normalized so reformatted SQL shares entries; params are (name, type, value) tuples.
+    normalized = ' '.join(query.split())
+    return hashlib.sha256(repr((normalized, tuple(params), version)).encode()).hexdigest()
+
+def query_cache_path(key):
+    return os.path.join(query_cache_dir, f"{key}.arrows")
+
+def read_cached_query(key):
+    # (IPC bytes, fetched_at) for key, or None.
+    path = query_cache_path(key)
+    try:
+        with open(path, 'rb') as f:
+            buffer = f.read()
+        fetched_at = os.stat(path).st_mtime
+        os.utime(path, (time.time(), fetched_at))
+    except FileNotFoundError:
+        # Missing, or evicted by another process in between.
+        count('misses')
+        return None
+    count('hits')
+    return buffer, fetched_at
+
+def write_cached_query(key, buffer, max_bytes):
+    if len(buffer) > max_bytes:
+        return
+    os.makedirs(query_cache_dir, exist_ok=True)
+    path = query_cache_path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer)
+    os.replace(tmp_path, path)
+    count('writes')
+    evict(max_bytes)
+
+def evict(max_bytes):
+    # Removes the least recently used results until the rest fit in max_bytes.
+    files = []
+    for entry in os.scandir(query_cache_dir):
+        if entry.name.endswith('.arrows'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_atime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            count('evictions')
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+def query_cache_stats():
+    # Counters for this process plus the files and bytes currently on disk (shared by every process).
+    with counters_lock:
+        stats = dict(counters)
+    sizes = [entry.stat().st_size for entry in os.scandir(query_cache_dir) if entry.name.endswith('.arrows')] if os.path.isdir(query_cache_dir) else []
+    stats.update(files=len(sizes), bytes=sum(sizes))
+    return stats
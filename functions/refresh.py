@@ -0,0 +1,144 @@
+import hashlib
+import threading
+import time
+
+# Stale-while-revalidate results, shared by every session in the process. Each key keeps its last good
+# result, which is always served: once it is refresh_after seconds old a background thread re-runs it
+# and swaps the new result in when it completes. Only the first fetch of a key (warm-up) runs in the caller.
+# A refresher thread also re-runs the few most recently viewed results before they go stale, so a viewer
+# coming back to one doesn't wait on the warehouse either. Each re-run is a warehouse query, so only results
+# viewed within the last refresh_after seconds are kept warm: a result nobody looks at is refreshed at most
+# once more.
+# A result's version is a hash of its content, so every process holding the same result agrees on it. Before
+# re-running a query, a refresh takes a fresher result another process saved (see warm in cached_result).
+
+# key -> {'value', 'version', 'fetched_at', 'refresh_seconds', 'refreshing', 'last_used', 'error', 'nbytes', 'fetch', 'warm'}
+results = {}
+results_lock = threading.Lock()
+# One lock per key, so concurrent warm-ups of the same key run the fetch once.
+key_locks = {}
+
+# Results beyond max_results, or beyond max_bytes of bytes values in total, are dropped, least recently used first.
+max_results = 32
+max_bytes = 1 << 30
+# The refresher wakes up every check_seconds and keeps at most max_warm_results recently used results fresh.
+check_seconds = 30
+max_warm_results = 4
+
+refresher = None
+
+def content_version(value):
+    # Same for equal values, whichever process fetched them.
+    content = value if isinstance(value, bytes) else repr(value).encode()
+    return hashlib.blake2b(content, digest_size=8).hexdigest()
+
+def store_entry(key, value, fetch, warm, fetched_at, refresh_seconds):
+    entry = {'value': value,
+             'version': content_version(value),
+             'fetched_at': fetched_at,
+             'refresh_seconds': refresh_seconds,
+             'refreshing': False,
+             'last_used': time.time(),
+             'error': None,
+             'nbytes': len(value) if isinstance(value, bytes) else 0,
+             'fetch': fetch,
+             'warm': warm}
+
+    # Entries are never modified in place once served, so swapping the dict entry is atomic for readers.
+    with results_lock:
+        previous = results.get(key)
+        if previous is not None:
+            entry['last_used'] = previous['last_used']
+        results[key] = entry
+        total_bytes = sum(e['nbytes'] for e in results.values())
+        for stale_key in sorted(results, key=lambda k: results[k]['last_used']):
+            if len(results) <= max_results and total_bytes <= max_bytes:
+                break
+            if stale_key != key:
+                total_bytes -= results.pop(stale_key)['nbytes']
+                key_locks.pop(stale_key, None)
+    return entry
+
+def fetch_entry(key, fetch, warm):
+    started = time.time()
+    value = fetch()
+    finished = time.time()
+    return store_entry(key, value, fetch, warm, finished, finished - started)
+
+def refresh(key, fetch, warm, refresh_after):
+    try:
+        # Another process may have refreshed the same key since; its saved result is taken instead of re-running the query.
+        saved = warm() if warm is not None else None
+        if saved is not None and time.time() - saved[1] < refresh_after:
+            store_entry(key, saved[0], fetch, warm, saved[1], None)
+        else:
+            fetch_entry(key, fetch, warm)
+    except Exception as error:
+        # Keep serving the last good result; the next check retries.
+        with results_lock:
+            if key in results:
+                results[key] = {**results[key], 'refreshing': False, 'error': repr(error)}
+
+def start_refresh(key, entry, refresh_after):
+    # Called with results_lock held. Starts at most one background refresh per key.
+    if entry['refreshing'] or time.time() - entry['fetched_at'] < refresh_after:
+        return
+    results[key] = {**entry, 'refreshing': True}
+    threading.Thread(target=refresh, args=(key, entry['fetch'], entry['warm'], refresh_after), name='billing-result-refresh', daemon=True).start()
+
+def refresh_loop(refresh_after):
+    while True:
+        time.sleep(check_seconds)
+        now = time.time()
+        with results_lock:
+            recent = [(key, entry) for key, entry in results.items() if now - entry['last_used'] < refresh_after]
+            recent.sort(key=lambda item: item[1]['last_used'], reverse=True)
+            for key, entry in recent[:max_warm_results]:
+                # Refresh a little ahead of refresh_after, so results in use never get to it.
+                start_refresh(key, entry, refresh_after - check_seconds)
+
+def ensure_refresher(refresh_after):
+    global refresher
+    with results_lock:
+        if refresher is None or not refresher.is_alive():
+            refresher = threading.Thread(target=refresh_loop, args=(refresh_after,), name='billing-result-refresher', daemon=True)
+            refresher.start()
+
+def cached_result(key, fetch, refresh_after, warm=None):
+    # Entry for key: the cached one (revalidated in the background once stale) or, on warm-up, a fresh one.
+    # warm, if given, returns a (value, fetched_at) saved elsewhere (e.g. on disk) or None; a saved value is
+    # served on warm-up instead of fetching, and revalidated like any other once stale. warm is also how a
+    # refresh finds a result saved by another process in the meantime.
+    ensure_refresher(refresh_after)
+    with results_lock:
+        entry = results.get(key)
+        if entry is not None:
+            entry = results[key] = {**entry, 'last_used': time.time()}
+            start_refresh(key, entry, refresh_after)
+            return entry
+        key_lock = key_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        with results_lock:
+            entry = results.get(key)
+        if entry is not None:
+            return entry
+        saved = warm() if warm is not None else None
+        if saved is None:
+            return fetch_entry(key, fetch, warm)
+        entry = store_entry(key, saved[0], fetch, warm, saved[1], None)
+        with results_lock:
+            start_refresh(key, entry, refresh_after)
+        return entry
+
+def result_status(key):
+    # Staleness and the duration of the last refresh (None when served from a saved value) for a cached key,
+    # or None before its warm-up.
+    with results_lock:
+        entry = results.get(key)
+    if entry is None:
+        return None
+    return {'age_seconds': time.time() - entry['fetched_at'],
+            'refresh_seconds': entry['refresh_seconds'],
+            'refreshing': entry['refreshing'],
+            'error': entry['error']}
@@ -0,0 +1,186 @@
+import pandas as pd
+from datetime import datetime
+from functions.aggregates import daily_index, range_totals, range_months
+from functions.cube import revenue_cube, cube_range
+from functions.subscriptions import active_subscriptions_by_month, active_from_events
+from functions.spans import span
+
+# Every number and series pages/billing_report.py displays, computed per section.
+# Each engine returns the same keys, so the page only renders:
+# - pandas (this module): the shared daily index and revenue cube over the loaded line items
+# - Snowflake (functions.snowflake_engine): the same aggregations pushed down to the warehouse
+# - DuckDB (functions.duckdb_engine) and Polars (functions.polars_engine): alternative engines over the same line items
+# The engines that aggregate at the source build their result with metrics_from_aggregates, so they can't drift
+# apart; tests/test_engine_parity.py checks each against this module.
+
+def revenue_by_month_frame(monthly_revenue):
+    # Monthly total revenue (indexed by 'YYYY-MM') with every month in between present.
+    all_months = pd.period_range(start=monthly_revenue.index.min(), end=monthly_revenue.index.max(), freq='M').astype(str)
+    revenue_by_month = monthly_revenue.reindex(all_months, fill_value=0).rename_axis('period').reset_index()
+    return revenue_by_month.set_axis(['period', 'total revenue'], axis=1)
+
+def mrr_frame(monthly_subscription_revenue, first_created_at, last_created_at):
+    # Subscription revenue for each month start between the first and last subscription line item.
+    if pd.isna(first_created_at):
+        return pd.DataFrame({'period': pd.Series(dtype=str), 'MRR': pd.Series(dtype='float64')})
+
+    all_months = pd.date_range(start=first_created_at, end=last_created_at, freq='MS').strftime('%Y-%m')
+    monthly_rev = monthly_subscription_revenue.reindex(all_months, fill_value=0).rename_axis('period').reset_index()
+    return monthly_rev.set_axis(['period', 'MRR'], axis=1)
+
+def month_start_frame(monthly_values, name):
+    # 'YYYY-MM' indexed Series -> created_at_month (first day of the month) and name columns.
+    frame = monthly_values.rename(name).rename_axis('created_at_month').reset_index()
+    frame['created_at_month'] = pd.PeriodIndex(frame['created_at_month'], freq='M').to_timestamp()
+    return frame
+
+def revenue_metrics(data, start_date, end_date, range_total, monthly):
+    revenue_by_month = revenue_by_month_frame(monthly['total_amount'])
+
+    # Filter only recurring subscription revenue and handle NaT values
+    subscription_created_at = data.loc[data['subscription_id'].notnull(), 'created_at'].dropna()
+    monthly_rev = mrr_frame(monthly['subscription_amount'], subscription_created_at.min(), subscription_created_at.max())
+
+    total_revenue = range_total['total_amount']
+
+    return {
+        'total_revenue': total_revenue,
+        'monthly_avg_revenue': revenue_by_month['total revenue'].mean(),
+        'daily_avg_revenue': total_revenue / ((end_date - start_date).days + 1),
+        'discounts_total': range_total['discount_amount'],
+        'discounts_average': range_total['discount_amount'] / range_total['line_count'],
+        'refunds_total': range_total['refund_amount'],
+        'refunds_average': range_total['refund_amount'] / range_total['line_count'],
+        'revenue_by_month': revenue_by_month,
+        'monthly_rev': monthly_rev,
+    }
+
+def subscription_metrics(data):
+    # Line items without a subscription are counted as one group
+    subscriptions_total = data['subscription_id'].nunique(dropna=False)
+
+    # Average amount of paid or completed line items
+    paid_payments = data[data['header_status'].isin(['paid', 'completed'])]
+    payments_total = paid_payments['total_amount'].mean()
+
+    # Subscriptions still running after the last day with line items, ending in the current month
+    max_created_at = data['created_at'].max().normalize()
+    active_subscriptions = data[data['subscription_period_ended_at'] > max_created_at]
+    current_month = datetime.now().month
+    active_subscriptions_current_month = active_subscriptions[active_subscriptions['subscription_period_ended_at'].dt.month == current_month]
+
+    # Subscriptions that ended on or before the last day with line items
+    canceled_subscriptions = data[(data['subscription_period_ended_at'].notnull()) &
+                                  (data['subscription_period_ended_at'] <= max_created_at)]
+
+    # Count subscriptions whose period overlaps each month in the selected range
+    monthly_active_subscriptions = active_subscriptions_by_month(
+        data,
+        start_month=data['created_at'].min().to_period('M'),
+        end_month=data['created_at'].max().to_period('M')
+    )
+
+    return {
+        'subscriptions_total': subscriptions_total,
+        'active_subscriptions_count_current_month': active_subscriptions_current_month['subscription_id'].nunique(),
+        'canceled_subscriptions_count': canceled_subscriptions['subscription_id'].nunique(),
+        'payments_total': payments_total,
+        'monthly_active_subscriptions': monthly_active_subscriptions,
+    }
+
+def product_metrics(cube):
+    # Total revenue per product and month over the cube cells in range; every product chart is a slice of it.
+    product_revenue = cube.groupby(['product_type', 'product_name', 'month'], observed=True)['total_amount'].sum().reset_index()
+    return {'product_revenue': product_revenue}
+
+def customer_metrics(data, monthly):
+    # Calculate CLV
+    clv = data.groupby('customer_name', observed=True)['total_amount'].sum().reset_index()
+    clv = clv.rename(columns={'total_amount': 'CLV'})
+
+    # Calculate churn rate
+    current_date = pd.Timestamp.now(tz='UTC').tz_localize(None)
+    last_transaction_date = data.groupby('customer_id', observed=True)['created_at'].max()
+    churned_customers = last_transaction_date[last_transaction_date < (current_date - pd.DateOffset(months=3))]
+
+    # Calculate current active customers (since max date in data)
+    max_date = data['created_at'].max().normalize()
+    current_active_customers = data[data['created_at'] >= max_date - pd.DateOffset(months=1)]
+
+    months = data['created_at'].dt.to_period('M')
+    monthly_customers = data['customer_id'].groupby(months).nunique()
+    monthly_customers.index = monthly_customers.index.astype(str)
+
+    return {
+        'clv': clv,
+        'avg_revenue_per_customer': clv['CLV'].mean(),
+        'churn_rate': len(churned_customers) / len(last_transaction_date),
+        'current_active_customer_count': current_active_customers['customer_id'].nunique(),
+        'revenue_over_time': month_start_frame(monthly['total_amount'], 'total_amount'),
+        # Distinct customers per month, counted exactly
+        'active_customers': month_start_frame(monthly_customers, 'customer_id'),
+    }
+
+def report_metrics(billing_data, data_date_filtered, start_date, end_date, version):
+    rows = len(data_date_filtered)
+
+    # Daily totals and their prefix sums, built once per dataset version. Range totals are two prefix
+    # lookups and every monthly series is rolled up from the days in range.
+    with span('daily index', len(billing_data)):
+        daily, prefix = daily_index(version, billing_data)
+        range_total = range_totals(daily, prefix, start_date, end_date)
+        monthly = range_months(daily, start_date, end_date)
+
+    # Daily revenue cube, also built once per dataset version; the range is a slice of its cells.
+    with span('revenue cube', len(billing_data)):
+        cube = cube_range(revenue_cube(version, billing_data), start_date, end_date)
+
+    metrics = {}
+    with span('revenue metrics', rows):
+        metrics.update(revenue_metrics(data_date_filtered, start_date, end_date, range_total, monthly))
+    with span('subscription metrics', rows):
+        metrics.update(subscription_metrics(data_date_filtered))
+    with span('product metrics', len(cube)):
+        metrics.update(product_metrics(cube))
+    with span('customer metrics', rows):
+        metrics.update(customer_metrics(data_date_filtered, monthly))
+    return metrics
+
+def metrics_from_aggregates(start_date, end_date, totals, monthly, months, started, ended, product_revenue, clv):
+    # report_metrics' result from aggregates computed at the source:
+    # - totals: total_amount, discount_amount, refund_amount and line_count over the range, the first and last
+    #   subscription line item (min_subscription_created_at, max_subscription_created_at), subscriptions_total,
+    #   active_subscriptions_count_current_month, canceled_subscriptions_count, payments_total, churn_rate
+    #   and current_active_customer_count
+    # - monthly: total_amount, subscription_amount and customer_count indexed by month ('YYYY-MM')
+    # - months: the months in range; started and ended: subscription intervals counted per month index
+    #   (started_idx or ended_idx, and event_count)
+    # - product_revenue and clv: frames as product_metrics and customer_metrics return them
+    revenue_by_month = revenue_by_month_frame(monthly['total_amount'])
+
+    return {
+        'total_revenue': totals['total_amount'],
+        'monthly_avg_revenue': revenue_by_month['total revenue'].mean(),
+        'daily_avg_revenue': totals['total_amount'] / ((end_date - start_date).days + 1),
+        'discounts_total': totals['discount_amount'],
+        'discounts_average': totals['discount_amount'] / totals['line_count'],
+        'refunds_total': totals['refund_amount'],
+        'refunds_average': totals['refund_amount'] / totals['line_count'],
+        'revenue_by_month': revenue_by_month,
+        'monthly_rev': mrr_frame(monthly['subscription_amount'], totals['min_subscription_created_at'], totals['max_subscription_created_at']),
+        'subscriptions_total': int(totals['subscriptions_total']),
+        'active_subscriptions_count_current_month': int(totals['active_subscriptions_count_current_month']),
+        'canceled_subscriptions_count': int(totals['canceled_subscriptions_count']),
+        # Average amount of paid or completed line items
+        'payments_total': totals['payments_total'],
+        'monthly_active_subscriptions': active_from_events(months,
+                                                           started['started_idx'].to_numpy(dtype='int64'), ended['ended_idx'].to_numpy(dtype='int64'),
+                                                           started['event_count'].to_numpy(dtype='float64'), ended['event_count'].to_numpy(dtype='float64')),
+        'product_revenue': product_revenue,
+        'clv': clv,
+        'avg_revenue_per_customer': clv['CLV'].mean(),
+        'churn_rate': totals['churn_rate'],
+        'current_active_customer_count': int(totals['current_active_customer_count']),
+        'revenue_over_time': month_start_frame(monthly['total_amount'], 'total_amount'),
+        'active_customers': month_start_frame(monthly['customer_count'], 'customer_id'),
+    }
@@ -0,0 +1,138 @@
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+import pyarrow as pa
+import pandas as pd
+from functions.keys import key_columns, categorical_from_dictionary
+
+# Normalized datasets published as memory-mapped Arrow files, so every worker process on the node
+# maps the same pages instead of loading its own copy. Each dataset has a versioned file plus a
+# '<name>.current' pointer that is swapped atomically on refresh, and a '<name>.lock' file: workers
+# hold it shared while mapping and exclusive while publishing or removing the dataset.
+shared_dir = os.environ.get('BILLING_SHARED_DIR', '/dev/shm/standardized_billing_model')
+
+# Datasets kept on the node (the directory is usually RAM-backed). Every date range is its own dataset,
+# so past this many the least recently mapped ones are removed, like functions.query.shared_line_items.
+max_shared_datasets = 8
+
+def shared_dataset_name(*key):
+    return hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+
+def dataset_path(name, version):
+    return os.path.join(shared_dir, f"{name}-{version}.arrow")
+
+def pointer_path(name):
+    return os.path.join(shared_dir, f"{name}.current")
+
+def lock_path(name):
+    return os.path.join(shared_dir, f"{name}.lock")
+
+@contextmanager
+def dataset_lock(name, operation):
+    # Holds the dataset's lock file with flock operation. A lock file removed along with its dataset
+    # while we waited no longer guards the name, so take the one now at the path instead.
+    while True:
+        with open(lock_path(name), 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                current = os.stat(lock_path(name)).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(lock.fileno()).st_ino:
+                yield lock
+                return
+
+def published_version(name):
+    try:
+        with open(pointer_path(name)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def publish(name, version, data):
+    # Write the new version next to the old one, then swap the pointer. Readers holding the old
+    # mapping keep it until they re-map; on Linux the removed file lives on until it is unmapped.
+    path = dataset_path(name, version)
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+    tmp_pointer = f"{pointer_path(name)}.{os.getpid()}.tmp"
+    with open(tmp_pointer, 'w') as f:
+        f.write(version)
+    os.replace(tmp_pointer, pointer_path(name))
+    remove_versions(name, keep=path)
+
+def remove_versions(name, keep=None):
+    for file_name in os.listdir(shared_dir):
+        stale = os.path.join(shared_dir, file_name)
+        if file_name.startswith(f"{name}-") and file_name.endswith('.arrow') and stale != keep:
+            os.remove(stale)
+
+def evict_datasets(keep):
+    # Removes the least recently mapped datasets (by pointer mtime) past max_shared_datasets.
+    # Datasets another worker is mapping or publishing right now are left for a later pass.
+    used = []
+    for file_name in os.listdir(shared_dir):
+        if file_name.endswith('.current'):
+            try:
+                used.append((os.stat(os.path.join(shared_dir, file_name)).st_mtime, file_name[:-len('.current')]))
+            except FileNotFoundError:
+                continue
+
+    for _, name in sorted(used, reverse=True)[max_shared_datasets:]:
+        if name == keep:
+            continue
+        with open(lock_path(name), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            remove_versions(name)
+            for path in (pointer_path(name), lock_path(name)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+def map_published(name, version):
+    # Plain columns are converted with split_blocks so numeric columns without nulls stay zero-copy,
+    # read-only views of the mapped file, and text columns stay Arrow-backed instead of becoming
+    # Python strings. Dictionary columns become categoricals over the mapped dictionaries.
+    source = pa.memory_map(dataset_path(name, version), 'r')
+    table = pa.ipc.open_file(source).read_all()
+
+    dictionary_columns = [field.name for field in table.schema if pa.types.is_dictionary(field.type)]
+    string_types = {pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}
+    data = table.select([col for col in table.column_names if col not in dictionary_columns]).to_pandas(
+        split_blocks=True, types_mapper=string_types.get
+    )
+    for col in dictionary_columns:
+        data[col] = categorical_from_dictionary(table.column(col).combine_chunks(), arrow_categories=col in key_columns)
+
+    # Column selection under copy-on-write keeps the blocks as they are instead of consolidating them into copies.
+    return data[table.column_names]
+
+def shared_frame(name, version, load):
+    # Maps the published dataset, publishing it first if this version is not there yet. The lock is
+    # held shared while mapping, so no other worker can replace or remove the file before it is open,
+    # and exclusive while publishing, so concurrent workers don't load and write the same version twice.
+    os.makedirs(shared_dir, exist_ok=True)
+    with dataset_lock(name, fcntl.LOCK_SH) as lock:
+        published = published_version(name) == version
+        if not published:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if published_version(name) != version:
+                publish(name, version, load())
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        # The pointer's mtime records the last use, for evict_datasets.
+        os.utime(pointer_path(name))
+        data = map_published(name, version)
+
+    if not published:
+        evict_datasets(keep=name)
+    return data
@@ -0,0 +1,185 @@
+import streamlit as st
+import pandas as pd
+from datetime import datetime
+from snowflake.snowpark import Session
+from snowflake.snowpark import functions as F
+from snowflake.snowpark import Window
+from snowflake.snowpark.types import StringType, TimestampType
+from functions.report import metrics_from_aggregates
+from functions.manifest import distinct_columns, manifest_from_row
+from functions.subscriptions import month_range
+from functions.cache import day_after
+
+# Snowpark engine for pages/billing_report.py. Every aggregation runs in Snowflake and only
+# aggregate rows come back: a handful of scalars, one row per month, product or customer.
+# Any Session works, including Session.builder.config('local_testing', True).create() over a table
+# saved with session.write_pandas / DataFrame.write.save_as_table. Conditional expressions use when/otherwise
+# (cast when the other branch is NULL) rather than iff, which local testing does not evaluate after a filter.
+# Zero amounts are 0.0, since local testing types a sum over when(..., amount).otherwise(0) as an integer.
+
+# One Snowpark session per process, created on first use and reused by every rerun and session.
+@st.cache_resource(show_spinner=False)
+def snowflake_session():
+    return Session.builder.configs(dict(st.secrets["snowflake"])).create()
+
+def line_items(session, table, start_date=None, end_date=None, columns=None):
+    # Line item DataFrame with the created_at range applied in the warehouse.
+    items = session.table(table)
+    if start_date is not None:
+        items = items.filter(F.col('created_at') >= F.lit(pd.Timestamp(start_date).to_pydatetime()))
+    if end_date is not None:
+        items = items.filter(F.col('created_at') < F.lit(day_after(end_date).to_pydatetime()))
+    if columns is not None:
+        items = items.select(*columns)
+    return items
+
+def fetch(dataframe):
+    # Snowflake upper-cases unquoted identifiers; the pages use lower-case column names.
+    result = dataframe.to_pandas()
+    result.columns = result.columns.str.lower()
+    return result
+
+def amount(name):
+    # Missing amounts add nothing to sums, as pandas sums skip NaN (and see functions.query.zero_filled_columns).
+    return F.coalesce(F.col(name), F.lit(0.0))
+
+def month_ordinal(column):
+    # Months since year 0, as in functions.subscriptions.month_ordinal.
+    return F.date_part('year', F.col(column)) * 12 + F.date_part('month', F.col(column)) - 1
+
+def dataset_manifest(session, table, timestamp_columns):
+    # Same shape as functions.manifest.build_manifest: one aggregate row plus one small distinct query per list.
+    items = session.table(table)
+    aggregates = [F.count(F.lit(1)).alias('row_count')]
+    for col in timestamp_columns:
+        aggregates += [F.min(col).alias(f'{col}_min'), F.max(col).alias(f'{col}_max')]
+    row = fetch(items.agg(*aggregates)).iloc[0].to_dict()
+    for key, col in distinct_columns.items():
+        row[key] = fetch(items.select(col).filter(F.col(col).is_not_null()).distinct().sort(col))[col].tolist()
+    return manifest_from_row(row, timestamp_columns)
+
+def load_line_items(session, table, columns, start_date=None, end_date=None):
+    # Raw line items for pages that need rows rather than aggregates (e.g. the schema overview).
+    return fetch(line_items(session, table, start_date, end_date, columns))[columns]
+
+def range_totals(items):
+    is_subscription = F.col('subscription_id').is_not_null()
+    is_paid = F.col('header_status').isin(['paid', 'completed'])
+    return fetch(items.agg(
+        F.sum(amount('total_amount')).alias('total_amount'),
+        F.sum(amount('discount_amount')).alias('discount_amount'),
+        F.sum(amount('refund_amount')).alias('refund_amount'),
+        F.count(F.lit(1)).alias('line_count'),
+        F.min('created_at').alias('min_created_at'),
+        F.max('created_at').alias('max_created_at'),
+        F.min(F.when(is_subscription, F.col('created_at')).cast(TimestampType())).alias('min_subscription_created_at'),
+        F.max(F.when(is_subscription, F.col('created_at')).cast(TimestampType())).alias('max_subscription_created_at'),
+        # Line items without a subscription are counted as one group
+        (F.count_distinct('subscription_id') + F.max(F.when(is_subscription, F.lit(0)).otherwise(F.lit(1)))).alias('subscriptions_total'),
+        F.sum(F.when(is_paid, amount('total_amount')).otherwise(F.lit(0.0))).alias('paid_amount'),
+        # Paid line items without a total are left out of the average, as in pandas
+        F.sum(F.when(is_paid & F.col('total_amount').is_not_null(), F.lit(1)).otherwise(F.lit(0))).alias('paid_count'),
+    )).iloc[0]
+
+def monthly_totals(items):
+    # Revenue, subscription revenue and distinct customers per created_at month ('YYYY-MM').
+    monthly = fetch(items.group_by(F.date_trunc('month', F.col('created_at')).alias('created_at_month')).agg(
+        F.sum(amount('total_amount')).alias('total_amount'),
+        F.sum(F.when(F.col('subscription_id').is_not_null(), amount('total_amount')).otherwise(F.lit(0.0))).alias('subscription_amount'),
+        F.count_distinct('customer_id').alias('customer_count'),
+    ))
+    monthly['month'] = pd.to_datetime(monthly.pop('created_at_month')).dt.strftime('%Y-%m')
+    return monthly.set_index('month').sort_index()
+
+def subscription_counts(items, max_created_at):
+    # Distinct subscriptions still running after the last day with line items and ending in the
+    # current month, and distinct subscriptions that ended on or before it.
+    ended_at = F.col('subscription_period_ended_at')
+    active = (ended_at > F.lit(max_created_at)) & (F.date_part('month', ended_at) == datetime.now().month)
+    canceled = ended_at.is_not_null() & (ended_at <= F.lit(max_created_at))
+    return fetch(items.agg(
+        F.count_distinct(F.when(active, F.col('subscription_id')).cast(StringType())).alias('active_subscriptions_count_current_month'),
+        F.count_distinct(F.when(canceled, F.col('subscription_id')).cast(StringType())).alias('canceled_subscriptions_count'),
+    )).iloc[0]
+
+def subscription_events(items, first_month, month_count):
+    # Subscription periods are merged per subscription (as in functions.subscriptions.merge_periods) and
+    # turned into +1/-1 month events in the warehouse; only the event counts per month index come back.
+    subscriptions = items.filter(F.col('subscription_id').is_not_null() & F.col('subscription_period_started_at').is_not_null())
+    # Open-ended periods stay active through the last month in range.
+    ended = F.coalesce(month_ordinal('subscription_period_ended_at') - first_month, F.lit(month_count))
+    periods = subscriptions.select(
+        F.col('subscription_id'),
+        F.least(F.greatest(month_ordinal('subscription_period_started_at') - first_month, F.lit(0)), F.lit(month_count)).alias('started_idx'),
+        F.least(F.greatest(ended + 1, F.lit(0)), F.lit(month_count)).alias('ended_idx'),
+    ).filter(F.col('started_idx') < F.col('ended_idx')).distinct()
+
+    # A period starting after every earlier one of its subscription has ended starts a new interval.
+    ordered = Window.partition_by('subscription_id').order_by('started_idx', 'ended_idx')
+    # The first period has no earlier ones (-1).
+    periods = periods.with_column('previous_reach', F.coalesce(F.max('ended_idx').over(ordered.rows_between(Window.UNBOUNDED_PRECEDING, -1)), F.lit(-1)))
+    periods = periods.with_column('new_interval', F.when(F.col('started_idx') > F.col('previous_reach'), F.lit(1)).otherwise(F.lit(0)))
+    periods = periods.with_column('interval_id', F.sum('new_interval').over(ordered.rows_between(Window.UNBOUNDED_PRECEDING, Window.CURRENT_ROW)))
+    events = periods.group_by('subscription_id', 'interval_id').agg(
+        F.min('started_idx').alias('started_idx'),
+        F.max('ended_idx').alias('ended_idx'),
+    )
+
+    return (fetch(events.group_by('started_idx').agg(F.count(F.lit(1)).alias('event_count'))),
+            fetch(events.group_by('ended_idx').agg(F.count(F.lit(1)).alias('event_count'))))
+
+def product_revenue(items):
+    product = fetch(items.group_by('product_type', 'product_name', F.date_trunc('month', F.col('created_at')).alias('created_at_month')).agg(
+        F.sum(amount('total_amount')).alias('total_amount'),
+    ))
+    product['month'] = pd.to_datetime(product.pop('created_at_month')).dt.strftime('%Y-%m')
+    return product[['product_type', 'product_name', 'month', 'total_amount']].sort_values(['product_type', 'product_name', 'month'], ignore_index=True)
+
+def customer_counts(items, max_date):
+    # Churned customers (no line item in the last 3 months) and customers active in the month before max_date.
+    churn_cutoff = (pd.Timestamp.now(tz='UTC').tz_localize(None) - pd.DateOffset(months=3)).to_pydatetime()
+    last_transaction = items.filter(F.col('customer_id').is_not_null()).group_by('customer_id').agg(F.max('created_at').alias('last_created_at'))
+    churn = fetch(last_transaction.agg(
+        F.count(F.lit(1)).alias('customer_count'),
+        F.sum(F.when(F.col('last_created_at') < F.lit(churn_cutoff), F.lit(1)).otherwise(F.lit(0))).alias('churned_count'),
+    )).iloc[0]
+
+    active_since = (max_date - pd.DateOffset(months=1)).to_pydatetime()
+    active = fetch(items.filter(F.col('created_at') >= F.lit(active_since)).agg(
+        F.count_distinct('customer_id').alias('current_active_customer_count'),
+    )).iloc[0]
+
+    return churn['churned_count'] / churn['customer_count'], active['current_active_customer_count']
+
+def report_metrics(session, table, start_date, end_date):
+    # Same keys as functions.report.report_metrics.
+    items = line_items(session, table, start_date, end_date)
+
+    totals = range_totals(items)
+    max_created_at = pd.Timestamp(totals['max_created_at']).normalize()
+    months, first_month = month_range(pd.Timestamp(totals['min_created_at']).to_period('M'),
+                                      pd.Timestamp(totals['max_created_at']).to_period('M'))
+    started, ended = subscription_events(items, first_month, len(months))
+
+    clv = fetch(items.filter(F.col('customer_name').is_not_null()).group_by('customer_name').agg(
+        F.sum(amount('total_amount')).alias('clv'),
+    )).rename(columns={'clv': 'CLV'}).sort_values('customer_name', ignore_index=True)
+    churn_rate, current_active_customer_count = customer_counts(items, max_created_at)
+
+    return metrics_from_aggregates(start_date, end_date,
+                                   {**totals,
+                                    **subscription_counts(items, max_created_at.to_pydatetime()),
+                                    'payments_total': totals['paid_amount'] / totals['paid_count'],
+                                    'churn_rate': churn_rate,
+                                    'current_active_customer_count': current_active_customer_count},
+                                   monthly_totals(items), months, started, ended, product_revenue(items), clv)
+
+# Aggregates per table and date range, through the pooled session.
+# Uses st.cache_data to only rerun when the range changes or after 10 min.
+@st.cache_data(ttl=600, show_spinner=False)
+def cached_report_metrics(table, start_date, end_date):
+    return report_metrics(snowflake_session(), table, start_date, end_date)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def cached_dataset_manifest(table, timestamp_columns):
+    return dataset_manifest(snowflake_session(), table, list(timestamp_columns))
@@ -0,0 +1,167 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import streamlit as st
+import pandas as pd
+
+# Named spans around the hot paths of a page run: wall time, rows processed and (with memory tracing)
+# bytes allocated. Spans are collected per script run; Streamlit runs each session's script on its own
+# thread, so library code can open spans without being handed the run. Outside a run span does nothing.
+# Memory is traced with tracemalloc, which covers Python, pandas and numpy allocations (not Arrow's) and
+# is process-wide, so concurrent sessions show up in each other's numbers. Tracing slows down every
+# thread, so it is only on while a run that asked for it is open.
+
+# Append every run's spans to this file as JSON lines, and/or keep the last run's spans in this file as
+# OpenMetrics text (e.g. for a node exporter textfile collector).
+spans_log = os.environ.get('BILLING_SPANS_LOG')
+openmetrics_file = os.environ.get('BILLING_OPENMETRICS_FILE')
+
+current = threading.local()
+
+# Threads with an open run tracing memory. Tracing started here is stopped once none is left; a run cut
+# short by a rerun leaves its thread in the set until the thread's next run, or until the thread ends.
+# Tracing started elsewhere (e.g. PYTHONTRACEMALLOC) is left on.
+tracing_threads = set()
+tracing_started = False
+tracing_lock = threading.Lock()
+
+def update_tracing(trace_memory):
+    global tracing_started
+    with tracing_lock:
+        thread = threading.current_thread()
+        if trace_memory:
+            tracing_threads.add(thread)
+        else:
+            tracing_threads.discard(thread)
+        tracing_threads.difference_update([t for t in tracing_threads if not t.is_alive()])
+
+        if tracing_threads and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            tracing_started = True
+        elif not tracing_threads and tracing_started:
+            tracemalloc.stop()
+            tracing_started = False
+
+def start_run(page, trace_memory=False):
+    # Starts collecting spans for this thread's script run and returns the list they are added to.
+    # With trace_memory, memory is traced until finish_run.
+    update_tracing(trace_memory)
+    current.page = page
+    current.spans = []
+    current.open = []
+    current.trace_memory = trace_memory
+    return current.spans
+
+def observe_peak():
+    # Folds the traced peak into every open span before it is reset for the next span, so nested
+    # spans each see the peak reached while they were open.
+    peak = tracemalloc.get_traced_memory()[1]
+    for record in current.open:
+        record['peak_bytes'] = max(record['peak_bytes'], peak)
+    tracemalloc.reset_peak()
+
+@contextmanager
+def span(name, rows=None):
+    # Yields the span record; set record['rows'] inside the block when the row count is only known there.
+    spans = getattr(current, 'spans', None)
+    if spans is None:
+        yield {}
+        return
+
+    record = {'span': name, 'rows': rows, 'seconds': None, 'allocated_bytes': None}
+    if current.trace_memory:
+        observe_peak()
+        record['start_bytes'] = record['peak_bytes'] = tracemalloc.get_traced_memory()[0]
+    current.open.append(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - started
+        if current.trace_memory:
+            observe_peak()
+            record['allocated_bytes'] = record.pop('peak_bytes') - record.pop('start_bytes')
+        current.open.remove(record)
+        spans.append(record)
+
+def spans_frame(spans):
+    return pd.DataFrame(spans, columns=['span', 'seconds', 'rows', 'allocated_bytes'])
+
+def spans_jsonl(spans, page=None, run_at=None):
+    # One JSON object per span.
+    run_at = run_at or time.time()
+    return ''.join(json.dumps({'page': page, 'run_at': run_at, **record}) + '\n' for record in spans)
+
+def openmetrics_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def spans_openmetrics(spans, page=None):
+    # OpenMetrics text exposition of the spans, one gauge per measure labelled by page and span.
+    # Spans opened more than once in a run (e.g. per chart) are summed.
+    totals = {}
+    for record in spans:
+        total = totals.setdefault(record['span'], {'seconds': 0.0, 'rows': None, 'allocated_bytes': None})
+        total['seconds'] += record['seconds']
+        for measure in ('rows', 'allocated_bytes'):
+            if record[measure] is not None:
+                total[measure] = (total[measure] or 0) + record[measure]
+
+    lines = []
+    for measure, unit in (('seconds', 'seconds'), ('rows', None), ('allocated_bytes', 'bytes')):
+        metric = f"billing_span_{measure}"
+        lines.append(f"# TYPE {metric} gauge")
+        if unit:
+            lines.append(f"# UNIT {metric} {unit}")
+        for name, total in totals.items():
+            if total[measure] is not None:
+                lines.append(f'{metric}{{page="{openmetrics_label(page)}",span="{openmetrics_label(name)}"}} {total[measure]}')
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+def export_spans(spans, page):
+    if spans_log:
+        with open(spans_log, 'a') as f:
+            f.write(spans_jsonl(spans, page))
+    if openmetrics_file:
+        # Temp file + rename, so a scrape never reads a partial file.
+        tmp_path = f"{openmetrics_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(spans_openmetrics(spans, page))
+        os.replace(tmp_path, openmetrics_file)
+
+def finish_run(show_panel=False):
+    # Exports the run's spans and, if asked, shows them in a sidebar panel with downloads.
+    spans, page = current.spans, current.page
+    current.spans = None
+    if current.trace_memory:
+        current.trace_memory = False
+        update_tracing(False)
+    export_spans(spans, page)
+
+    if show_panel:
+        with st.sidebar.expander('Debug: spans', expanded=True):
+            st.dataframe(spans_frame(spans), hide_index=True, use_container_width=True)
+            st.download_button('Spans (JSON lines)', spans_jsonl(spans, page), file_name='spans.jsonl')
+            st.download_button('Spans (OpenMetrics)', spans_openmetrics(spans, page), file_name='spans.txt')
+    return spans
+
+def fragment_spans(page, trace_memory=False):
+    # Decorator for st.fragment functions. A fragment rerun executes only the fragment, outside any page
+    # run, so it gets a run of its own: exported like any other, but not shown, as fragments can't write
+    # to the sidebar. Pass the page run's trace_memory, so only the session that asked traces memory.
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(current, 'spans', None) is not None:
+                return func(*args, **kwargs)
+            start_run(page, trace_memory)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                finish_run()
+        return wrapper
+    return decorator
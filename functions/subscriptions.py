@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+def month_ordinal(timestamps):
+    # Months since year 0, so month arithmetic is plain integer arithmetic.
+    return timestamps.dt.year * 12 + timestamps.dt.month - 1
+
+def month_range(start_month, end_month):
+    # Every month between start_month and end_month (inclusive), and the month ordinal of the first one.
+    months = pd.period_range(start=start_month, end=end_month, freq='M')
+    return months, months[0].year * 12 + months[0].month - 1
+
+def active_from_events(months, started_idx, ended_idx, started_count=None, ended_count=None):
+    # Each interval adds +1 in its first month and -1 after its last one (indexes into months);
+    # a cumulative sum over those events gives the active count for every month in one pass.
+    # The counts weight already grouped indexes, e.g. when the events were counted in the warehouse.
+    month_count = len(months)
+    events = np.bincount(started_idx, weights=started_count, minlength=month_count + 1) - np.bincount(ended_idx, weights=ended_count, minlength=month_count + 1)
+    active = np.cumsum(events)[:month_count].astype('int64')
+
+    return pd.DataFrame({'Month': months.astype(str), 'Active Subscriptions': active})
+
+def period_indexes(started, ended, first_month, month_count):
+    # Month ordinals of period starts and ends -> half-open [started_idx, ended_idx) indexes into the
+    # months in range. Open-ended periods (NaN end) stay active through the last month in range.
+    started_idx = np.clip(started - first_month, 0, month_count).astype('int64')
+    ended_idx = np.clip(np.nan_to_num(ended - first_month, nan=month_count) + 1, 0, month_count).astype('int64')
+    return started_idx, ended_idx
+
+def merge_periods(subscription, started_idx, ended_idx):
+    # Merges each subscription's [started_idx, ended_idx) periods where they overlap or touch, so a
+    # subscription counts once in every month any of its periods covers and not in the gaps between.
+    overlaps = started_idx < ended_idx
+    subscription, started_idx, ended_idx = subscription[overlaps], started_idx[overlaps], ended_idx[overlaps]
+    if len(subscription) == 0:
+        return started_idx, ended_idx
+
+    order = np.lexsort((started_idx, subscription))
+    subscription, started_idx, ended_idx = subscription[order], started_idx[order], ended_idx[order]
+
+    # Furthest end reached so far within each subscription: one running max, offset per subscription so
+    # an earlier subscription's ends never carry over (subscriptions are sorted, ends are <= month count).
+    offset = subscription * (ended_idx.max() + 1)
+    reach = np.maximum.accumulate(ended_idx + offset) - offset
+    first = np.r_[True, subscription[1:] != subscription[:-1]]
+    new_interval = first | (started_idx > np.r_[-1, reach[:-1]])
+    last = np.r_[new_interval[1:], True]
+    return started_idx[new_interval], reach[last]
+
+def active_subscriptions_by_month(data, start_month, end_month):
+    # Count the subscriptions with a period overlapping each month between start_month and end_month
+    # (inclusive), with one event per merged interval instead of one check per row.
+    months, first_month = month_range(start_month, end_month)
+    month_count = len(months)
+
+    # One period per line item, duplicates included (merge_periods folds them); subscription ids as integer codes.
+    periods = data.dropna(subset=['subscription_id', 'subscription_period_started_at'])
+    subscription = pd.factorize(periods['subscription_id'])[0]
+    started = month_ordinal(periods['subscription_period_started_at']).to_numpy(dtype='float64')
+    ended = month_ordinal(periods['subscription_period_ended_at']).to_numpy(dtype='float64', na_value=np.nan)
+
+    started_idx, ended_idx = period_indexes(started, ended, first_month, month_count)
+    return active_from_events(months, *merge_periods(subscription, started_idx, ended_idx))
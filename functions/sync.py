@@ -0,0 +1,86 @@
+import os
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+import pandas as pd
+from functions.cache import cache_dir, read_columnar_cache, day_after
+
+# Incremental local copy of a warehouse line item table, kept as an Arrow IPC file sorted by created_at.
+# A refresh fetches only the line items created at or after the stored watermark (the newest created_at)
+# minus a lookback window, since late refunds and status changes land on line items that already exist.
+# Everything in the copy from that point on is replaced by what was fetched, with line items matched by
+# line_item_id, so refresh cost follows new data rather than the total history.
+
+def synced_table_path(table):
+    return os.path.join(cache_dir, f"{table}.sync.arrow")
+
+def read_synced_table(path):
+    return read_columnar_cache(path) if os.path.exists(path) else None
+
+def table_metadata(table, key):
+    value = (table.schema.metadata or {}).get(key.encode())
+    return value.decode() if value is not None else None
+
+def synced_version(path):
+    # Changes whenever a refresh changed the copy's contents.
+    return table_metadata(read_columnar_cache(path), 'version')
+
+def timestamp_scalar(value, column):
+    # pandas Timestamp (tz-naive UTC) as a scalar comparable with a timestamp column of any unit or time zone.
+    return pa.scalar(pd.Timestamp(value).to_pydatetime(), type=pa.timestamp('us')).cast(column.type)
+
+def created_at_range(table, start_date=None, end_date=None):
+    # Line items in [start_date, end_date].
+    created_at = table.column('created_at')
+    mask = None
+    if start_date is not None:
+        mask = pc.greater_equal(created_at, timestamp_scalar(start_date, created_at))
+    if end_date is not None:
+        upper = pc.less(created_at, timestamp_scalar(day_after(end_date), created_at))
+        mask = upper if mask is None else pc.and_(mask, upper)
+    return table if mask is None else table.filter(mask)
+
+def merge_line_items(existing, changes, since):
+    # Line items created before since are kept unless changes has a newer copy of the same line_item_id;
+    # from since on, changes is the complete set, which also drops line items deleted in the warehouse.
+    created_at = existing.column('created_at')
+    kept = existing.filter(pc.and_(
+        pc.less(created_at, timestamp_scalar(since, created_at)),
+        pc.invert(pc.is_in(existing.column('line_item_id'), value_set=changes.column('line_item_id'))),
+    ))
+    # kept precedes since and changes starts at it, so the result stays sorted by created_at.
+    return pa.concat_tables([kept, changes])
+
+def write_synced_table(path, table, version):
+    high = pc.max(table.column('created_at')).as_py()
+    metadata = {'version': version, 'watermark': '' if high is None else pd.Timestamp(high).isoformat()}
+
+    # Temp file + rename, so readers always see a complete copy.
+    os.makedirs(cache_dir, exist_ok=True)
+    table = table.replace_schema_metadata(metadata)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def sync_line_items(path, fetch, lookback):
+    # fetch(since) returns the warehouse line items created at or after since (every line item when since
+    # is None) as an Arrow table. Returns path once the copy there is up to date.
+    existing = read_synced_table(path)
+    watermark = table_metadata(existing, 'watermark') if existing is not None else None
+
+    if not watermark:
+        write_synced_table(path, fetch(None).sort_by('created_at'), f"{time.time_ns():x}")
+        return path
+
+    since = pd.Timestamp(watermark).tz_localize(None) - lookback
+    changes = fetch(since).cast(existing.schema.remove_metadata()).sort_by([('created_at', 'ascending'), ('line_item_id', 'ascending')])
+
+    # Nothing new and nothing changed in the lookback window: keep the copy (and its version) as it is.
+    window = created_at_range(existing, since).replace_schema_metadata(None)
+    if window.sort_by([('created_at', 'ascending'), ('line_item_id', 'ascending')]).equals(changes):
+        return path
+
+    write_synced_table(path, merge_line_items(existing.replace_schema_metadata(None), changes, since), f"{time.time_ns():x}")
+    return path
@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from functions.cache import arrow_schema
+
+# Seeded synthetic line_item_enhanced data at any scale, shaped like the Dunder Mifflin sample:
+# headers of 1-12 line items, 100 products in 7 names and 3 types, three currencies, partial refunds,
+# subscriptions with monthly or annual periods, and customers who sign up and churn over time.
+# The same rows, seed and start always produce the same data. Rows are generated in batches, so
+# writing 50M rows needs no more memory than one batch plus the customer table.
+
+product_names = {'office supplies': ['paper', 'ink', 'stationery'],
+                 'furniture': ['chair', 'desk'],
+                 'office equipment': ['printer', 'copier']
+                 }
+currencies = ['USD', 'EUR', 'GBP']
+currency_weights = [0.7, 0.2, 0.1]
+header_statuses = ['completed', 'pending', 'cancelled']
+header_status_weights = [0.8, 0.12, 0.08]
+billing_types = ['subscription', 'recurring', 'one-time', 'invoiceitem']
+payment_methods = ['credit_card', 'bank_transfer', 'paypal']
+countries = ['United States', 'Canada', 'United Kingdom', 'Germany', 'France', 'Ireland', 'Netherlands',
+             'Spain', 'Italy', 'Australia', 'Japan', 'Brazil', 'Mexico', 'India', 'Singapore']
+
+def product_catalog(product_count=100):
+    # product_id -> (product_type, product_name), fixed for every seed.
+    names = [(product_type, name) for product_type, type_names in product_names.items() for name in type_names]
+    return [names[product_id % len(names)] for product_id in range(product_count)]
+
+def numbered(prefix, values, separator=' ', width=0):
+    # 'prefix<separator><number>' strings built in Arrow, without a Python string per row.
+    digits = pa.array(values, type=pa.int64()).cast(pa.string())
+    if width:
+        digits = pc.utf8_lpad(digits, width, '0')
+    return pc.binary_join_element_wise(pa.scalar(prefix), digits, separator)
+
+def prefixed_ids(prefix, values):
+    return numbered(prefix, values, '-', 12)
+
+def timestamps(values, missing=None):
+    return pa.array(values, type=pa.timestamp('ns'), mask=missing)
+
+def choices(options, index, missing=None):
+    # options[index] per row as an Arrow string column.
+    return pa.array(np.asarray(options, dtype=object)[index], type=pa.string(), mask=missing)
+
+def optional_ids(prefix, values, missing):
+    return pc.if_else(pa.array(missing), pa.nulls(len(missing), pa.string()), prefixed_ids(prefix, values))
+
+def customer_table(customer_count, seed, start, end):
+    # Every customer signs up at some point in [start, end) and churns after an exponential lifetime
+    # (mean 18 months); churn dates past end mean still active. Larger customers have lower ids.
+    rng = np.random.default_rng([seed, 0])
+    span = (end - start).value
+    signed_up = start.value + (rng.random(customer_count) * span).astype('int64')
+    lifetime = (rng.exponential(18 * 30.4, customer_count) * 86400e9).astype('int64')
+    return {'signed_up': signed_up,
+            'churned': np.minimum(signed_up + lifetime, end.value),
+            'subscriber': rng.random(customer_count) < 0.6,
+            'currency': rng.choice(len(currencies), customer_count, p=currency_weights),
+            'country': rng.integers(0, len(countries), customer_count)}
+
+def line_item_batch(first_header, header_count, customers, catalog, rng, end):
+    # One batch of whole headers: header-level fields are drawn once per header and repeated per line item.
+    sizes = rng.integers(1, 13, header_count)
+    rows = int(sizes.sum())
+    header = np.repeat(np.arange(header_count), sizes)
+    line_item_index = np.arange(rows) - np.repeat(np.cumsum(sizes) - sizes, sizes) + 1
+
+    customer_count = len(customers['signed_up'])
+    customer = (rng.random(header_count) ** 2 * customer_count).astype('int64')
+    signed_up = customers['signed_up'][customer]
+    header_created = signed_up + (rng.random(header_count) * (customers['churned'][customer] - signed_up)).astype('int64')
+    status = rng.choice(len(header_statuses), header_count, p=header_status_weights)
+    is_refund = rng.random(header_count) < 0.08
+
+    customer = customer[header]
+    created_at = (header_created[header] + rng.integers(0, 60, rows) * 10**9) // 10**9 * 10**9
+    status = status[header]
+    is_refund = is_refund[header]
+
+    product_id = rng.integers(0, len(catalog), rows)
+    quantity = rng.integers(1, 11, rows)
+    unit_amount = np.round(rng.lognormal(5.5, 0.8, rows), 2)
+    gross = unit_amount * quantity
+    discount_amount = np.round(np.where(rng.random(rows) < 0.4, gross * rng.uniform(0, 0.1, rows), 0), 2)
+    tax_amount = np.round((gross - discount_amount) * 0.08, 2)
+    total_amount = np.round(gross - discount_amount + tax_amount, 2)
+    refund_amount = np.where(is_refund, np.round(total_amount * rng.uniform(0.2, 1, rows), 2), np.nan)
+    fee_amount = np.round(total_amount * 0.029, 2)
+
+    # Subscribers' subscription and recurring line items belong to one subscription per customer,
+    # billed monthly or (for a quarter of them) annually.
+    billing_type = rng.integers(0, len(billing_types), rows)
+    is_subscription = customers['subscriber'][customer] & (billing_type < 2)
+    ended_at = created_at + np.where(customer % 4 == 0, 365, 30) * 86400 * 10**9
+
+    is_paid = status == 0
+    header_ids = prefixed_ids('hdr', first_header + np.arange(header_count))
+
+    return {
+        'header_id': header_ids.take(pa.array(header)),
+        'line_item_id': prefixed_ids('li', (first_header + header) * 16 + line_item_index),
+        'line_item_index': pa.array(line_item_index, type=pa.int64()),
+        'record_type': choices(['line_item', 'header'], (line_item_index == 1).astype(int)),
+        'created_at': timestamps(created_at),
+        'currency': choices(currencies, customers['currency'][customer]),
+        'header_status': choices(header_statuses, status),
+        'product_id': pa.array(product_id, type=pa.int64()),
+        'product_name': choices([name for _, name in catalog], product_id),
+        'transaction_type': choices(['sale', 'refund'], is_refund.astype(int)),
+        'billing_type': choices(billing_types, billing_type),
+        'product_type': choices([product_type for product_type, _ in catalog], product_id),
+        'quantity': pa.array(quantity, type=pa.int64()),
+        'unit_amount': pa.array(unit_amount),
+        'discount_amount': pa.array(discount_amount),
+        'tax_amount': pa.array(tax_amount),
+        'total_amount': pa.array(total_amount),
+        'payment_id': optional_ids('pay', first_header + header, ~is_paid),
+        'payment_method_id': optional_ids('pm', customer, ~is_paid),
+        'payment_method': choices(payment_methods, customer % len(payment_methods), ~is_paid),
+        'payment_at': timestamps(created_at + 3600 * 10**9, ~is_paid),
+        'fee_amount': pa.array(fee_amount),
+        'refund_amount': pa.array(refund_amount, from_pandas=True),
+        'subscription_id': optional_ids('sub', customer, ~is_subscription),
+        'subscription_period_started_at': timestamps(created_at, ~is_subscription),
+        'subscription_period_ended_at': timestamps(ended_at, ~is_subscription),
+        'subscription_status': choices(['inactive', 'active'], (ended_at > end.value).astype(int), ~is_subscription),
+        'customer_id': prefixed_ids('cus', customer),
+        'customer_level': choices(['customer'], np.zeros(rows, dtype=int)),
+        'customer_name': numbered('Customer', customer),
+        'customer_company': numbered('Company', customer % 500),
+        'customer_email': pc.binary_join_element_wise(numbered('customer', customer, ''), pa.scalar('example.com'), '@'),
+        'customer_city': numbered('City', customer % 2000),
+        'customer_country': choices(countries, customers['country'][customer]),
+    }
+
+def line_item_batches(rows, dtypes, seed=0, start='2021-01-01', months=36, batch_headers=100_000):
+    # Record batches totalling exactly rows line items, with the columns and types of dtypes
+    # (functions.query.data_dtypes), covering the months from start.
+    schema = arrow_schema(dtypes)
+    start = pd.Timestamp(start)
+    end = start + pd.DateOffset(months=months)
+    customers = customer_table(max(rows // 8, 1), seed, start, end)
+    catalog = product_catalog()
+
+    produced = 0
+    first_header = 0
+    batch = 0
+    while produced < rows:
+        batch += 1
+        columns = line_item_batch(first_header, batch_headers, customers, catalog, np.random.default_rng([seed, batch]), end)
+        record_batch = pa.RecordBatch.from_pydict({col: columns[col] for col in schema.names}, schema=schema)
+        record_batch = record_batch.slice(0, rows - produced)
+        produced += record_batch.num_rows
+        first_header += batch_headers
+        yield record_batch
+
+def write_line_items_csv(path, rows, dtypes, seed=0, **kwargs):
+    # Same CSV layout as the bundled sample, written batch by batch through a temp file.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pacsv.CSVWriter(tmp_path, arrow_schema(dtypes)) as writer:
+        for batch in line_item_batches(rows, dtypes, seed, **kwargs):
+            writer.write_batch(batch)
+    os.replace(tmp_path, path)
+    return path
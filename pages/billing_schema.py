@@ -5,7 +5,7 @@ import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime
-from functions.query import query_results
+from functions.query import query_results, warehouse
 
 # Set page configuration
 st.set_page_config(
@@ -14,10 +14,8 @@ st.set_page_config(
 )
 
 st.title("Standardized Billing Line Item Model Schema Overview")
-billing_data = query_results(destination="BigQuery")
+billing_data, _ = query_results(destination=warehouse)
 
-# Convert 'created_at' column to datetime if it's not already in datetime format
-billing_data['created_at'] = pd.to_datetime(billing_data['created_at'])
 # Filter out rows where Column1 and Column2 are not null
 filtered_df = billing_data.dropna(subset=['subscription_period_started_at'])
 
@@ -0,0 +1,79 @@
+import pytest
+import numpy as np
+import pandas as pd
+from datetime import date
+from snowflake.snowpark import Session
+from functions import query, duckdb_engine, polars_engine, snowflake_engine
+from functions.filters import filter_data
+from functions.report import report_metrics
+
+# pandas, DuckDB, Polars and Snowflake (a Snowpark local testing session) over the bundled sample must
+# return the same report for any range.
+ranges = [
+    (date(2023, 6, 1), date(2024, 8, 31)),
+    (date(2022, 6, 14), date(2024, 6, 13)),
+    (date(2023, 2, 10), date(2023, 3, 5)),
+    (date(2024, 1, 1), date(2024, 1, 1)),
+]
+
+@pytest.fixture(scope='module')
+def line_items():
+    return query.load_line_items('BigQuery', columns=query.report_columns)
+
+@pytest.fixture(scope='module')
+def source():
+    source, _ = query.line_item_source('BigQuery')
+    return source
+
+@pytest.fixture(scope='module')
+def snowflake_session():
+    # The sample saved as a table; Snowflake upper-cases unquoted column names.
+    session = Session.builder.config('local_testing', True).create()
+    sample = pd.read_csv(query.data_path, usecols=query.report_columns)
+    for col in sample.columns.intersection(query.timestamp_columns):
+        sample[col] = pd.to_datetime(sample[col], utc=True).dt.tz_localize(None)
+    sample.columns = sample.columns.str.upper()
+    session.create_dataframe(sample).write.save_as_table('line_items', mode='overwrite')
+    return session
+
+def comparable_frame(frame):
+    # Text columns as plain objects and rows in a fixed order, so engines returning rows in a
+    # different order or with different text dtypes compare equal.
+    frame = frame.astype({col: object for col in frame.columns if not pd.api.types.is_numeric_dtype(frame[col]) and not pd.api.types.is_datetime64_any_dtype(frame[col])})
+    keys = [col for col in frame.columns if not pd.api.types.is_float_dtype(frame[col])]
+    return frame.sort_values(keys, ignore_index=True) if keys else frame.reset_index(drop=True)
+
+def metrics_differences(expected, actual, rtol=1e-9, skip=()):
+    # Keys whose values differ between two report_metrics results, with a short description of each difference.
+    differences = {}
+    for key in expected.keys() - set(skip):
+        if key not in actual:
+            differences[key] = 'missing'
+        elif isinstance(expected[key], pd.DataFrame):
+            try:
+                pd.testing.assert_frame_equal(comparable_frame(expected[key]), comparable_frame(actual[key]),
+                                              check_dtype=False, check_exact=False, rtol=rtol)
+            except AssertionError as error:
+                differences[key] = str(error).strip().splitlines()[0]
+        elif not np.isclose(float(expected[key]), float(actual[key]), rtol=rtol, atol=0):
+            differences[key] = f'{expected[key]!r} != {actual[key]!r}'
+    return differences
+
+def pandas_metrics(data, start_date, end_date):
+    return report_metrics(data, filter_data(start_date, end_date, data), start_date, end_date, f"test-{start_date}-{end_date}")
+
+@pytest.mark.parametrize('start_date, end_date', ranges)
+def test_duckdb_matches_pandas(line_items, start_date, end_date):
+    expected = pandas_metrics(line_items, start_date, end_date)
+    assert metrics_differences(expected, duckdb_engine.report_metrics(line_items, start_date, end_date)) == {}
+
+@pytest.mark.parametrize('start_date, end_date', ranges)
+def test_polars_matches_pandas(line_items, source, start_date, end_date):
+    expected = pandas_metrics(line_items, start_date, end_date)
+    assert metrics_differences(expected, polars_engine.report_metrics(polars_engine.scan_line_items(source, start_date, end_date), start_date, end_date)) == {}
+
+# Local testing evaluates expressions row by row (about a minute for a year of the sample), so only the short ranges run.
+@pytest.mark.parametrize('start_date, end_date', ranges[2:])
+def test_snowflake_matches_pandas(line_items, snowflake_session, start_date, end_date):
+    expected = pandas_metrics(line_items, start_date, end_date)
+    assert metrics_differences(expected, snowflake_engine.report_metrics(snowflake_session, 'line_items', start_date, end_date)) == {}
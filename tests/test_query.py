@@ -0,0 +1,70 @@
+import pytest
+import pandas as pd
+from datetime import date
+from functions import query
+from functions.cache import read_csv_table
+from functions.sync import created_at_range
+
+# BigQuery reads against a stand-in client serving the bundled sample, so the query building and the
+# Arrow fetch path run without credentials.
+
+class StandInJob:
+    def __init__(self, table):
+        self.table = table
+
+    def result(self):
+        return self
+
+    def to_arrow_iterable(self):
+        return iter(self.table.to_batches(max_chunksize=5000))
+
+class StandInClient:
+    # Answers line_item_query's select: the selected columns of the sample within the created_at parameters.
+    def __init__(self, sample):
+        self.sample = sample
+        self.queries = []
+
+    def query(self, sql, job_config=None):
+        params = {param.name: param.value for param in job_config.query_parameters}
+        self.queries.append((sql, params))
+        columns = [col.strip() for col in sql.split('select ')[1].split('\nfrom')[0].split(',')]
+        end_date = pd.Timestamp(params['end_date']) - pd.Timedelta(days=1) if 'end_date' in params else None
+        return StandInJob(created_at_range(self.sample, params.get('start_date'), end_date).select(columns))
+
+@pytest.fixture(scope='module')
+def client():
+    return StandInClient(read_csv_table(query.data_path, query.data_dtypes))
+
+def test_line_item_query_selects_columns_and_range():
+    sql, params = query.line_item_query(['created_at', 'total_amount'], date(2024, 1, 1), date(2024, 1, 31))
+    assert sql == f"select created_at, total_amount\nfrom {query.line_item_table()}\nwhere created_at >= @start_date and created_at < @end_date"
+    assert params == (('start_date', 'TIMESTAMP', pd.Timestamp('2024-01-01').to_pydatetime()),
+                      ('end_date', 'TIMESTAMP', pd.Timestamp('2024-02-01').to_pydatetime()))
+
+def test_line_item_query_without_range():
+    sql, params = query.line_item_query()
+    assert sql == f"select {', '.join(query.data_columns)}\nfrom {query.line_item_table()}"
+    assert params == ()
+
+def test_line_item_query_rejects_unknown_columns():
+    with pytest.raises(ValueError, match='not_a_column'):
+        query.line_item_query(['created_at', 'not_a_column'])
+
+def test_query_results_with_client(client, monkeypatch):
+    start_date, end_date = date(2024, 1, 1), date(2024, 1, 31)
+    # The same line items read from the local sample.
+    expected = query.load_line_items('BigQuery', columns=query.report_columns)
+    created_at = expected['created_at']
+    expected = expected[(created_at >= pd.Timestamp(start_date, tz=created_at.dt.tz)) & (created_at < pd.Timestamp(date(2024, 2, 1), tz=created_at.dt.tz))]
+
+    monkeypatch.setattr(query, 'use_warehouse', True)
+    monkeypatch.setattr(query, 'sync_warehouse', False)
+    data, version = query.query_results('BigQuery', start_date, end_date, query.report_columns, client=client)
+
+    assert version is None
+    assert list(data.columns) == query.report_columns
+    # Category labels are ordered as first seen, which differs between the ranged and the full read.
+    pd.testing.assert_frame_equal(data.reset_index(drop=True), expected.reset_index(drop=True), check_categorical=False)
+    sql, params = client.queries[-1]
+    assert 'where created_at >= @start_date and created_at < @end_date' in sql
+    assert pd.Timestamp(params['end_date']) == pd.Timestamp('2024-02-01', tz='UTC')